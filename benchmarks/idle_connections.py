@@ -0,0 +1,91 @@
+""" measures the memory held by idle websocket connections: one `SubscriptionManager`
+per connection, with a reader per subscription, subscribed through the process's
+connection pool. no publications are sent, so the figure is the cost of a connection
+that is only waiting.
+
+    DJANGO_SETTINGS_MODULE=tests.settings python benchmarks/idle_connections.py \
+        --connections 10000 --channels 3
+
+the settings must configure `redis_pubsub.backends.MemoryBackend` so that no redis
+server is needed, the database is not queried.
+"""
+import argparse
+import asyncio
+import gc
+import os
+import sys
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "tests.settings")
+
+import django  # noqa
+django.setup()
+
+from redis_pubsub.util import ChannelReader, SubscriptionManager, get_pool  # noqa
+
+
+TARGET = 100000
+
+
+@asyncio.coroutine
+def callback(channel_name, model):
+    return True
+
+
+@asyncio.coroutine
+def connect(pool, connection_id, channels):
+    """ an idle connection listening to a private channel and `channels - 1` channels
+    shared with every other connection.
+    """
+    manager = SubscriptionManager(pool.lease())
+    names = ["user:{0}:messages".format(connection_id)]
+    names.extend("broadcast:{0}".format(i) for i in range(channels - 1))
+    for channel_id, name in enumerate(names):
+        reader = ChannelReader.from_ids(connection_id, channel_id, name, manager=manager)
+        reader.callback(callback)
+        yield from reader.listen()
+    return manager
+
+
+@asyncio.coroutine
+def run(connections, channels):
+    pool = get_pool()
+    # warm up the pool and the import caches before measuring.
+    managers = [(yield from connect(pool, -1, channels))]
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    for connection_id in range(connections):
+        managers.append((yield from connect(pool, connection_id, channels)))
+    gc.collect()
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+
+    stats = after.compare_to(before, "filename")
+    total = sum(stat.size_diff for stat in stats)
+    per_connection = total / connections
+    print("connections:           {0}".format(connections))
+    print("channels / connection: {0}".format(channels))
+    print("bytes / connection:    {0:.0f}".format(per_connection))
+    print("{0} connections:    {1:.1f} MiB".format(
+        TARGET, per_connection * TARGET / 2 ** 20))
+    print("\ntop allocations:")
+    for stat in stats[:5]:
+        print("  {0}".format(stat))
+
+    for manager in managers:
+        yield from manager.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--connections", type=int, default=10000)
+    parser.add_argument("--channels", type=int, default=3)
+    args = parser.parse_args()
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(run(args.connections, args.channels))
+
+
+if __name__ == "__main__":
+    main()
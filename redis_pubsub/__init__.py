@@ -4,12 +4,37 @@ from django.conf import settings
 
 
 REDIS_PUBSUB = getattr(settings, "REDIS_PUBSUB", {})
+REDIS_PUBSUB.setdefault("backend", "redis_pubsub.backends.RedisBackend")
 REDIS_PUBSUB.setdefault("address", ("localhost", 6379))
+REDIS_PUBSUB.setdefault("shard_replicas", 100)
 REDIS_PUBSUB.setdefault("db", 0)
+REDIS_PUBSUB.setdefault("pool_max_channels", 1000)
+REDIS_PUBSUB.setdefault("pool_reconnect_backoff", (0.1, 30))
 REDIS_PUBSUB.setdefault("password", None)
 REDIS_PUBSUB.setdefault("tokenauth_method", "redis_pubsub.auth.authtoken_method")
 REDIS_PUBSUB.setdefault("websocket_url_prefix", "")
 REDIS_PUBSUB.setdefault("append_slash", settings.APPEND_SLASH)
+REDIS_PUBSUB.setdefault("rate_limit", None)
+REDIS_PUBSUB.setdefault("outbox", False)
+REDIS_PUBSUB.setdefault("outbox_batch_size", 500)
+REDIS_PUBSUB.setdefault("outbox_interval", 0.5)
+REDIS_PUBSUB.setdefault("offline_queue", False)
+REDIS_PUBSUB.setdefault("presence_ttl", 60)
+REDIS_PUBSUB.setdefault("callback_concurrency", 1)
+REDIS_PUBSUB.setdefault("dedup_window", None)
+REDIS_PUBSUB.setdefault("dedup_size", 1024)
+REDIS_PUBSUB.setdefault("serialize_cache_size", 1024)
+REDIS_PUBSUB.setdefault("receipts", "redis_pubsub.receipts.SQLReceiptStore")
+REDIS_PUBSUB.setdefault("receipts_address", None)
+REDIS_PUBSUB.setdefault("receipts_ttl", 7 * 24 * 60 * 60)
+REDIS_PUBSUB.setdefault("receipts_compact_interval", 10)
+REDIS_PUBSUB.setdefault("receipts_compact_batch", 1000)
+REDIS_PUBSUB.setdefault("receipts_retention_days", 30)
+REDIS_PUBSUB.setdefault("websocket_ping_interval", None)
+REDIS_PUBSUB.setdefault("websocket_pong_timeout", None)
+REDIS_PUBSUB.setdefault("websocket_idle_timeout", None)
+REDIS_PUBSUB.setdefault("watchdog_threshold", None)
+REDIS_PUBSUB.setdefault("watchdog_interval", 0.05)
 
 
 def get_application(loop=None):
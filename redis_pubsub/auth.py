@@ -1,10 +1,50 @@
+import functools as ft
+
 from django.contrib.auth import get_user_model
 
 __all__ = (
-    "authtoken_method", "authjwt_method"
+    "get_lazy_user", "authtoken_method", "authjwt_method"
     )
 
 
+def get_lazy_user(pk, claims=None):
+    """ returns an instance of AUTH_USER_MODEL with every field but its primary key
+    deferred, built without a query. it is a real user instance, so it can be assigned
+    to foreign keys, used in query filters and compared with other users. the first
+    read of any other field loads all of them with one query, and raises
+    `User.DoesNotExist` if the user was deleted. `claims` are kept as `.token_claims`.
+
+    .. code:: python
+
+        user = get_lazy_user(1, {"username": "andrew"})
+        user.pk  # 1, no query
+        user.get_full_name()  # loads every field
+    """
+    User = get_user_model()
+    attname = User._meta.pk.attname
+    try:
+        from django.db.models.query_utils import deferred_class_factory
+    except ImportError:  # pragma: no cover
+        # django >= 1.10 defers the fields that are not passed to `from_db`
+        klass = User
+    else:
+        klass = deferred_class_factory(User, [
+            field.attname for field in User._meta.concrete_fields
+            if field.attname != attname])
+    user = klass.from_db(None, [attname], [pk])
+    user.token_claims = claims or {}
+    # deferred fields are loaded through `refresh_from_db`, one field per call
+    user.refresh_from_db = ft.partial(_load_deferred_fields, user)
+    return user
+
+
+def _load_deferred_fields(user, using=None, fields=None, **kwargs):
+    deferred = user.get_deferred_fields()
+    if fields is not None and deferred.issuperset(fields):
+        fields = list(deferred)
+    type(user).refresh_from_db(user, using=using, fields=fields, **kwargs)
+
+
 def authtoken_method(token):
     """ an authentication method using rest_framework Token
     """
@@ -16,7 +56,10 @@ def authtoken_method(token):
 
 
 def authjwt_method(token):
-    """ an authentication method using rest_framework_jwt
+    """ an authentication method using rest_framework_jwt. when the payload holds the
+    user's id the user is built with `get_lazy_user`, so a handshake only checks that
+    the user still exists, without loading its fields. a user deleted after the token
+    was issued is rejected.
     """
     import jwt
     from rest_framework_jwt.authentication import (jwt_decode_handler,
@@ -27,6 +70,12 @@ def authjwt_method(token):
         return None
 
     User = get_user_model()
+    if payload.get("user_id") is not None:
+        user = get_lazy_user(payload["user_id"], payload)
+        if not User.objects.filter(pk=user.pk).exists():
+            return None
+        return user
+
     username = jwt_get_username_from_payload(payload)
     if not username:  # pragma: no cover
         return None
@@ -0,0 +1,513 @@
+import asyncio
+import collections
+import json
+import threading
+import time
+
+import redis
+import aioredis
+
+from . import REDIS_PUBSUB
+from .ratelimit import TAKE_TOKEN_FUNCTION, TOKEN_BUCKET_SCRIPT, TokenBucket, bucket_key
+from .sharding import HashRing, get_addresses
+
+
+__all__ = (
+    "BaseBackend", "RedisBackend", "MemoryBackend", "LocalChannel", "history_key",
+    "presence_key"
+    )
+
+
+def history_key(channel):
+    return "redis_pubsub:history:{0}".format(channel)
+
+
+def presence_key(channel):
+    return "redis_pubsub:presence:{0}".format(channel)
+
+
+# publishes ARGV[2] on many channels of one shard. ARGV[1] is the current time, then
+# every channel has four arguments: its name, history length, rate and burst (a rate of
+# 0 is not limited), and two keys: its rate limit bucket and its history. returns the
+# number of receivers, or -1 if the channel was throttled, and the seconds until the
+# channel has a token, per channel.
+PUBLISH_MANY_SCRIPT = TAKE_TOKEN_FUNCTION + """
+local now = tonumber(ARGV[1])
+local message = ARGV[2]
+local results = {}
+for i = 1, (#ARGV - 2) / 4 do
+    local offset = 2 + (i - 1) * 4
+    local history = tonumber(ARGV[offset + 2])
+    local rate = tonumber(ARGV[offset + 3])
+    local allowed, wait = 1, 0
+    if rate > 0 then
+        allowed, wait = take_token(KEYS[i * 2 - 1], rate, tonumber(ARGV[offset + 4]),
+                                   now, 1)
+    end
+    local receivers = -1
+    if allowed == 1 then
+        if history > 0 then
+            redis.call("LPUSH", KEYS[i * 2], message)
+            redis.call("LTRIM", KEYS[i * 2], 0, history - 1)
+        end
+        receivers = redis.call("PUBLISH", ARGV[offset + 1], message)
+    end
+    results[i] = {receivers, tostring(wait)}
+end
+return results
+"""
+
+
+class BaseBackend:
+    """ the interface shared by all pubsub backends. a backend instance is both a
+    publisher and a single subscriber connection, it quacks like an aioredis connection
+    so that it can be handed directly to a `SubscriptionManager`.
+
+    - `publish(channel, message, history=0)` is syncronous, it may be called from any
+      thread. with `history`, the message is also kept in the channel's history, which
+      is capped at `history` messages.
+    - `publish_many(channels, message, history=None, limits=None)` publishes one
+      message on many channels, `history` and `limits` map channel names to history
+      lengths and `(rate, burst)` rate limits. returns a dict of channel names to the
+      number of receivers, or None if the channel was throttled, and the seconds until
+      the channel has a token.
+    - `publish_batch(publications)` publishes a list of `(channel, message, history)`
+      tuples, returning the total number of receivers.
+    - `history(channel, count)` returns up to the last `count` messages kept in the
+      channel's history, oldest first.
+    - `set_presence(channel, members, ttl)` marks `members` as present on the channel
+      for `ttl` seconds, `clear_presence(channel, members)` removes them and
+      `get_presence(channel)` returns the set of present members.
+      `set_presence_many(presences, ttl)` takes a dict of channel names to members.
+    - `take_token(channel, rate, burst)` takes a token from the channel's rate limit
+      bucket, returning whether the publication is allowed and how many seconds remain
+      until it would be.
+    - `subscribe(*channels)` is a coroutine that returns a list of channel objects with
+      the same interface as `aioredis.Channel` (`wait_message`, `get`, `get_json`,
+      `name` and `close`).
+    - `unsubscribe(*channels)` is a coroutine.
+    - `close()` and `wait_closed()` tear down the subscriber connection.
+    """
+    def shard_for(self, channel):
+        """ the shard that `channel` is routed to, backends without sharding have a
+        single shard.
+        """
+        return None
+
+    def publish(self, channel, message, history=0):
+        raise NotImplementedError
+
+    def publish_many(self, channels, message, history=None, limits=None):
+        history, limits = history or {}, limits or {}
+        results = {}
+        for channel in channels:
+            if limits.get(channel):
+                allowed, wait = self.take_token(channel, *limits[channel])
+                if not allowed:
+                    results[channel] = None, wait
+                    continue
+            receivers = self.publish(channel, message, history=history.get(channel, 0))
+            results[channel] = receivers, 0
+        return results
+
+    def publish_batch(self, publications):
+        return sum(self.publish(channel, message, history=history)
+                   for channel, message, history in publications)
+
+    def history(self, channel, count):
+        raise NotImplementedError
+
+    def set_presence(self, channel, members, ttl):
+        raise NotImplementedError
+
+    def set_presence_many(self, presences, ttl):
+        for channel, members in presences.items():
+            self.set_presence(channel, members, ttl)
+
+    def clear_presence(self, channel, members):
+        raise NotImplementedError
+
+    def get_presence(self, channel):
+        raise NotImplementedError
+
+    def take_token(self, channel, rate, burst):
+        raise NotImplementedError
+
+    @asyncio.coroutine
+    def subscribe(self, *channels):
+        raise NotImplementedError
+
+    @asyncio.coroutine
+    def unsubscribe(self, *channels):
+        raise NotImplementedError
+
+    @property
+    def closed(self):
+        raise NotImplementedError
+
+    def close(self):
+        raise NotImplementedError
+
+    @asyncio.coroutine
+    def wait_closed(self):
+        pass
+
+
+class RedisBackend(BaseBackend):
+    """ publishes using syncronous `redis.Redis` clients and subscribes using `aioredis`
+    connections. `REDIS_PUBSUB["address"]` may be a list of addresses, in which case
+    channels are sharded across the servers with a consistent hash ring and every
+    channel is published and subscribed on its own shard. connections are created
+    lazily and per shard, so a backend that is only used for publishing never opens a
+    subscriber connection.
+    """
+    def __init__(self, address=None, db=None, password=None):
+        self.addresses = get_addresses(address or REDIS_PUBSUB["address"])
+        self.db = REDIS_PUBSUB["db"] if db is None else db
+        self.password = password or REDIS_PUBSUB["password"]
+        self.ring = HashRing(self.addresses)
+        self._clients = {}
+        self._scripts = {}
+        self._connections = {}
+        self._lock = asyncio.Lock()
+        self._closed = False
+
+    def shard_for(self, channel):
+        return self.ring.get_node(channel)
+
+    def get_client(self, address):
+        client = self._clients.get(address)
+        if client is None:
+            host, port = address
+            client = redis.Redis(host, port, db=self.db, password=self.password)
+            self._clients[address] = client
+        return client
+
+    @asyncio.coroutine
+    def get_connection(self, address):
+        with (yield from self._lock):
+            connection = self._connections.get(address)
+            if connection is None or connection.closed:
+                connection = yield from aioredis.create_redis(
+                    address, db=self.db, password=self.password)
+                self._connections[address] = connection
+                self._closed = False
+        return connection
+
+    def _group_by_shard(self, channels):
+        shards = collections.OrderedDict()
+        for channel in channels:
+            shards.setdefault(self.shard_for(channel), []).append(channel)
+        return shards
+
+    def publish(self, channel, message, history=0):
+        client = self.get_client(self.shard_for(channel))
+        if not history:
+            return client.publish(channel, message)
+        key = history_key(channel)
+        pipeline = client.pipeline()
+        pipeline.lpush(key, message)
+        pipeline.ltrim(key, 0, history - 1)
+        pipeline.publish(channel, message)
+        return pipeline.execute()[-1]
+
+    def publish_many(self, channels, message, history=None, limits=None):
+        """ publish on every shard with a single script call, which also appends to the
+        channels histories and takes their rate limit tokens.
+        """
+        history, limits = history or {}, limits or {}
+        now = time.time()
+        results = {}
+        for address, names in self._group_by_shard(channels).items():
+            keys, args = [], [now, message]
+            for name in names:
+                rate, burst = limits.get(name) or (0, 0)
+                keys.extend((bucket_key(name), history_key(name)))
+                args.extend((name, history.get(name, 0), rate, burst))
+            publish = self.get_script(address, PUBLISH_MANY_SCRIPT)
+            for name, (receivers, wait) in zip(names, publish(keys=keys, args=args)):
+                results[name] = (receivers if receivers >= 0 else None), float(wait)
+        return results
+
+    def publish_batch(self, publications):
+        """ publish in one pipeline per shard.
+        """
+        shards = collections.OrderedDict()
+        for publication in publications:
+            shards.setdefault(self.shard_for(publication[0]), []).append(publication)
+        receivers = 0
+        for address, publications_ in shards.items():
+            pipeline = self.get_client(address).pipeline(transaction=False)
+            for channel, message, history in publications_:
+                if history:
+                    pipeline.lpush(history_key(channel), message)
+                    pipeline.ltrim(history_key(channel), 0, history - 1)
+                pipeline.publish(channel, message)
+            results = iter(pipeline.execute())
+            for channel, message, history in publications_:
+                if history:
+                    next(results), next(results)
+                receivers += next(results)
+        return receivers
+
+    def history(self, channel, count):
+        client = self.get_client(self.shard_for(channel))
+        return list(reversed(client.lrange(history_key(channel), 0, count - 1)))
+
+    def set_presence(self, channel, members, ttl):
+        """ present members are kept in a sorted set scored by their expiry time.
+        """
+        self.set_presence_many({channel: members}, ttl)
+
+    def set_presence_many(self, presences, ttl):
+        """ set the presences of many channels in one pipeline per shard.
+        """
+        expires = time.time() + ttl
+        for address, names in self._group_by_shard(presences).items():
+            pipeline = self.get_client(address).pipeline(transaction=False)
+            for name in names:
+                key = presence_key(name)
+                pipeline.zadd(key, **{member: expires for member in presences[name]})
+                pipeline.expire(key, int(ttl) + 1)
+            pipeline.execute()
+
+    def clear_presence(self, channel, members):
+        self.get_client(self.shard_for(channel)).zrem(presence_key(channel), *members)
+
+    def get_presence(self, channel):
+        client = self.get_client(self.shard_for(channel))
+        members = client.zrangebyscore(presence_key(channel), time.time(), "+inf")
+        return set(member.decode("utf-8") for member in members)
+
+    def get_script(self, address, script):
+        """ register a lua script with the client of a shard.
+        """
+        key = address, script
+        if key not in self._scripts:
+            self._scripts[key] = self.get_client(address).register_script(script)
+        return self._scripts[key]
+
+    def take_token(self, channel, rate, burst):
+        take = self.get_script(self.shard_for(channel), TOKEN_BUCKET_SCRIPT)
+        args = [rate, burst, time.time(), 1]
+        allowed, wait = take(keys=[bucket_key(channel)], args=args)
+        return bool(allowed), float(wait)
+
+    @asyncio.coroutine
+    def subscribe(self, *channels):
+        subscribed = {}
+        for address, names in self._group_by_shard(channels).items():
+            connection = yield from self.get_connection(address)
+            channels_ = yield from connection.subscribe(*names)
+            subscribed.update(zip(names, channels_))
+        return [subscribed[name] for name in channels]
+
+    @asyncio.coroutine
+    def unsubscribe(self, *channels):
+        for address, names in self._group_by_shard(channels).items():
+            connection = self._connections.get(address)
+            if connection is not None and not connection.closed:
+                yield from connection.unsubscribe(*names)
+
+    @property
+    def closed(self):
+        return self._closed
+
+    def close(self):
+        self._closed = True
+        for connection in self._connections.values():
+            connection.close()
+
+    @asyncio.coroutine
+    def wait_closed(self):
+        for connection in self._connections.values():
+            yield from connection.wait_closed()
+
+
+_EMPTY = object()
+_CLOSED = object()
+
+
+class LocalChannel:
+    """ an in process stand in for `aioredis.Channel`. messages are put on the channel
+    with `.put` which is safe to call from any thread. once `.forward` is called the
+    messages are handed to a sink instead of being queued, and a forwarded channel
+    never allocates its queue.
+    """
+    def __init__(self, name, loop=None):
+        self._loop = loop or asyncio.get_event_loop()
+        self._queue_ = None
+        self._message = _EMPTY
+        self._closed = False
+        self._sink = None
+        self.name = name.encode("utf-8") if isinstance(name, str) else name
+
+    @property
+    def _queue(self):
+        if self._queue_ is None:
+            self._queue_ = asyncio.Queue(loop=self._loop)
+        return self._queue_
+
+    @property
+    def is_active(self):
+        return not self._closed or (self._queue_ is not None and
+                                    not self._queue_.empty())
+
+    @property
+    def closed(self):
+        return self._closed
+
+    def put(self, message):
+        self._loop.call_soon_threadsafe(self.put_nowait, message)
+
+    def put_nowait(self, message):
+        """ put a message on the channel from within the event loop.
+        """
+        if self._closed:
+            return
+        if self._sink is not None:
+            self._sink((self.name, message))
+        else:
+            self._queue.put_nowait(message)
+
+    def forward(self, sink):
+        """ hand every message, along with the channel's name, to `sink` rather than
+        queueing it. messages already queued are forwarded first.
+        """
+        while self._queue_ is not None and not self._queue_.empty():
+            message = self._queue_.get_nowait()
+            if message is not _CLOSED:
+                sink((self.name, message))
+        self._sink = sink
+
+    def close(self):
+        if not self._closed:
+            self._closed = True
+            if self._sink is None:
+                self._queue.put_nowait(_CLOSED)
+
+    @asyncio.coroutine
+    def wait_message(self):
+        """ wait for a message to arrive, returns False once the channel is closed.
+        """
+        if self._message is _EMPTY:
+            self._message = yield from self._queue.get()
+        return self._message is not _CLOSED
+
+    @asyncio.coroutine
+    def get(self):
+        if not (yield from self.wait_message()):
+            return None
+        message, self._message = self._message, _EMPTY
+        return message
+
+    @asyncio.coroutine
+    def get_json(self):
+        message = yield from self.get()
+        if isinstance(message, bytes):
+            message = message.decode("utf-8")
+        if message is not None:
+            message = json.loads(message)
+        return message
+
+
+class MemoryBackend(BaseBackend):
+    """ an in process backend for single process deployments and for running the test
+    suite without a redis server. all instances in a process share the same channels.
+    """
+    _lock = threading.Lock()
+    _channels = {}
+    _buckets = {}
+    _history = {}
+    _presence = {}
+
+    def __init__(self, **kwargs):
+        self._subscribed = {}
+        self._closed = False
+
+    def publish(self, channel, message, history=0):
+        with self._lock:
+            if history:
+                kept = self._history.get(channel)
+                if kept is None or kept.maxlen != history:
+                    kept = self._history[channel] = collections.deque(kept or (),
+                                                                      maxlen=history)
+                kept.append(message)
+            receivers = list(self._channels.get(channel, ()))
+        for receiver in receivers:
+            receiver.put(message)
+        return len(receivers)
+
+    def history(self, channel, count):
+        with self._lock:
+            kept = list(self._history.get(channel, ()))
+        return kept[-count:] if count else []
+
+    def set_presence(self, channel, members, ttl):
+        self.set_presence_many({channel: members}, ttl)
+
+    def set_presence_many(self, presences, ttl):
+        expires = time.time() + ttl
+        with self._lock:
+            for channel, members in presences.items():
+                self._presence.setdefault(channel, {}).update(
+                    (member, expires) for member in members)
+
+    def clear_presence(self, channel, members):
+        with self._lock:
+            present = self._presence.get(channel, {})
+            for member in members:
+                present.pop(member, None)
+
+    def get_presence(self, channel):
+        now = time.time()
+        with self._lock:
+            present = self._presence.get(channel, {})
+            return set(member for member, expires in present.items() if expires > now)
+
+    def take_token(self, channel, rate, burst):
+        with self._lock:
+            bucket = self._buckets.get(channel)
+            if bucket is None or (bucket.rate, bucket.burst) != (rate, burst):
+                bucket = self._buckets[channel] = TokenBucket(rate, burst)
+            return bucket.take()
+
+    @asyncio.coroutine
+    def subscribe(self, *channels):
+        subscribed = []
+        for name in channels:
+            channel = self._subscribed.get(name)
+            if channel is None or channel.closed:
+                with self._lock:
+                    receivers = self._channels.setdefault(name, set())
+                    receivers.discard(channel)
+                    channel = LocalChannel(name)
+                    receivers.add(channel)
+                self._subscribed[name] = channel
+            subscribed.append(channel)
+        return subscribed
+
+    @asyncio.coroutine
+    def unsubscribe(self, *channels):
+        for name in channels:
+            channel = self._subscribed.pop(name, None)
+            if channel is None:
+                continue
+            with self._lock:
+                receivers = self._channels.get(name, set())
+                receivers.discard(channel)
+                if not receivers:
+                    self._channels.pop(name, None)
+            channel.close()
+
+    @property
+    def closed(self):
+        return self._closed
+
+    def close(self):
+        self._closed = True
+        for name, channel in list(self._subscribed.items()):
+            with self._lock:
+                self._channels.get(name, set()).discard(channel)
+            channel.close()
+        self._subscribed.clear()
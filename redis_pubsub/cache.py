@@ -0,0 +1,123 @@
+import collections
+import threading
+import time
+
+from . import REDIS_PUBSUB, metrics
+
+
+__all__ = (
+    "LRUCache", "SerializationCache", "serialized"
+    )
+
+
+_MISSING = object()
+
+
+class LRUCache:
+    """ a thread safe, size bounded, least recently used cache. entries optionally
+    expire `ttl` seconds after they were set.
+    """
+    def __init__(self, maxsize, ttl=None, name=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.name = name
+        self.hits = 0
+        self.misses = 0
+        self._data = collections.OrderedDict()
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return self.get(key, _MISSING, count=False) is not _MISSING
+
+    def _count(self, hit):
+        if hit:
+            self.hits += 1
+        else:
+            self.misses += 1
+        if self.name is not None:
+            metrics.incr("{0}.{1}".format(self.name, "hits" if hit else "misses"))
+
+    def get(self, key, default=None, count=True):
+        with self._lock:
+            entry = self._data.get(key, _MISSING)
+            if entry is not _MISSING and self.ttl is not None and \
+                    entry[1] < time.monotonic():
+                self.discard(key)
+                entry = _MISSING
+            if entry is not _MISSING:
+                self._data.move_to_end(key)
+        if count:
+            self._count(entry is not _MISSING)
+        return default if entry is _MISSING else entry[0]
+
+    def set(self, key, value):
+        expires = None if self.ttl is None else time.monotonic() + self.ttl
+        with self._lock:
+            self._data[key] = value, expires
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self.discard(next(iter(self._data)))
+
+    def discard(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.hits = self.misses = 0
+
+    def stats(self):
+        return {"size": len(self._data), "maxsize": self.maxsize,
+                "hits": self.hits, "misses": self.misses}
+
+
+class SerializationCache(LRUCache):
+    """ a cache of serialized publications shared by every reader in the process, so
+    a publication fanned out to many subscribers is serialized once. entries are keyed
+    by `(model label, pk, version, fields)` and can be invalidated per instance.
+    """
+    def __init__(self, maxsize, name="serialize_cache"):
+        super(SerializationCache, self).__init__(maxsize, name=name)
+        self._versions = {}
+
+    def get_or_set(self, key, serialize):
+        if not self.maxsize:
+            return serialize()
+        value = self.get(key, _MISSING)
+        if value is _MISSING:
+            value = serialize()
+            self.set(key, value)
+        return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._versions.setdefault(key[:2], set()).add(key)
+            super(SerializationCache, self).set(key, value)
+
+    def discard(self, key):
+        with self._lock:
+            super(SerializationCache, self).discard(key)
+            keys = self._versions.get(key[:2])
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._versions[key[:2]]
+
+    def invalidate(self, label, pk):
+        """ drop every cached version of an instance.
+        """
+        with self._lock:
+            for key in list(self._versions.get((label, pk), ())):
+                self.discard(key)
+
+    def clear(self):
+        with self._lock:
+            super(SerializationCache, self).clear()
+            self._versions.clear()
+
+
+serialized = SerializationCache(REDIS_PUBSUB["serialize_cache_size"])
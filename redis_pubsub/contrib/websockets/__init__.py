@@ -5,7 +5,11 @@ from django.utils.module_loading import import_string
 
 from aiohttp.web import Application
 
+from redis_pubsub import REDIS_PUBSUB
+from redis_pubsub.receipts import get_receipt_store, run_compactor
+
 from .util import websocket, websocket_pubsub
+from .watchdog import LoopWatchdog
 
 __all__ = (
     "websocket", "websocket_pubsub", "setup"
@@ -36,4 +40,9 @@ def setup(loop=None):
     for handler in handlers:
         handler = import_string(handler)
         app.router.add_route(*handler.route)
+
+    if get_receipt_store().compacts and REDIS_PUBSUB["receipts_compact_interval"]:
+        loop.create_task(run_compactor())
+    if REDIS_PUBSUB["watchdog_threshold"]:
+        LoopWatchdog(loop).start()
     return app
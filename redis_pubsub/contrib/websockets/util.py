@@ -1,16 +1,21 @@
 import asyncio
 import functools as ft
+import json
 import logging
 import os
 
 from django.conf import settings
 from django.utils.module_loading import import_string
 
-from aiohttp.web import WebSocketResponse, HTTPForbidden, Application
+from aiohttp.web import WebSocketResponse, HTTPForbidden, Application, MsgType
+from aiohttp.websocket import Message
 
-from redis_pubsub import REDIS_PUBSUB
+from redis_pubsub import REDIS_PUBSUB, metrics
+from redis_pubsub.compat import ensure_future
 from redis_pubsub.util import get_async_redis, SubscriptionManager
 
+from .watchdog import label_task
+
 
 # a method that takes a token and returns an AUTH_USER_MODEL or None
 authentication_method = import_string(REDIS_PUBSUB["tokenauth_method"])
@@ -31,6 +36,200 @@ def handle_auth(token):
     return user
 
 
+class ManagedWebSocketResponse(WebSocketResponse):
+    """ a WebSocketResponse that reads incoming frames in a background task and queues
+    them for `.receive()`. this lets the heartbeat see pongs and client activity while a
+    handler is only pushing publications. a connection is reaped when a ping is not
+    answered within `pong_timeout` seconds, or when no message has been sent or
+    received for `idle_timeout` seconds. reaping cancels the handler, so its
+    `SubscriptionManager` is stopped immediately.
+
+    with `batch=True`, text frames passed to `.send_str` are buffered and sent as a
+    single frame holding a JSON array of the buffered strings. the buffer is flushed on
+    the next loop iteration, or after `batch_interval` seconds, or as soon as it holds
+    `batch_size` strings.
+    """
+    def __init__(self, *, ping_interval=None, pong_timeout=None, idle_timeout=None,
+                 batch=False, batch_size=None, batch_interval=None, **kwargs):
+        kwargs["autoping"] = False
+        super(ManagedWebSocketResponse, self).__init__(**kwargs)
+        self.ping_interval = ping_interval
+        self.pong_timeout = pong_timeout
+        self.idle_timeout = idle_timeout
+        self.last_seen = None
+        self.last_active = None
+        self.reaped = False
+        self.on_reap = None
+        self._frames = asyncio.Queue()
+        self._final = None
+        self._reading = None
+        self._heartbeat = None
+        self.batch = batch
+        self.batch_size = batch_size
+        self.batch_interval = batch_interval
+        self._batch = []
+        self._flush_handle = None
+
+    @staticmethod
+    def _time():
+        return asyncio.get_event_loop().time()
+
+    @asyncio.coroutine
+    def prepare(self, request):
+        resp_impl = yield from super(ManagedWebSocketResponse, self).prepare(request)
+        self.last_seen = self.last_active = self._time()
+        self._start_reading()
+        if self.ping_interval or self.idle_timeout:
+            self._heartbeat = ensure_future(self._beat())
+        return resp_impl
+
+    def _start_reading(self):
+        self._reading = ensure_future(self._read_frames())
+        self._reading.add_done_callback(self._reading_done)
+
+    def _reading_done(self, task):
+        """ wake `.receive()` when the reader task stops without queueing a closing
+        frame, so a handler waiting on a broken connection is not left hanging.
+        """
+        if task.cancelled():
+            self._frames.put_nowait(Message(MsgType.closed, None, None))
+            return
+        err = task.exception()
+        if err is not None:
+            logger.warning("reading websocket frames failed: {0}".format(err))
+            self._frames.put_nowait(Message(MsgType.error, err, None))
+
+    @asyncio.coroutine
+    def _read_frames(self):
+        while True:
+            message = yield from super(ManagedWebSocketResponse, self).receive()
+            self.last_seen = self._time()
+            if message.tp == MsgType.ping:
+                self.pong(message.data)
+                continue
+            if message.tp == MsgType.pong:
+                continue
+            self.last_active = self.last_seen
+            self._frames.put_nowait(message)
+            if message.tp in (MsgType.close, MsgType.closed, MsgType.error):
+                return
+
+    @asyncio.coroutine
+    def receive(self):
+        if self._reading is None:
+            return (yield from super(ManagedWebSocketResponse, self).receive())
+        if self._final is not None:
+            return self._final
+        message = yield from self._frames.get()
+        if message.tp in (MsgType.close, MsgType.closed, MsgType.error):
+            self._final = message
+        return message
+
+    def send_str(self, data):
+        self.last_active = self._time()
+        if not self.batch:
+            return super(ManagedWebSocketResponse, self).send_str(data)
+
+        self._batch.append(data)
+        if self.batch_size and len(self._batch) >= self.batch_size:
+            self.flush()
+        elif self._flush_handle is None:
+            loop = asyncio.get_event_loop()
+            if self.batch_interval:
+                self._flush_handle = loop.call_later(self.batch_interval, self.flush)
+            else:
+                self._flush_handle = loop.call_soon(self.flush)
+
+    def send_bytes(self, data):
+        self.last_active = self._time()
+        self.flush()
+        super(ManagedWebSocketResponse, self).send_bytes(data)
+
+    def flush(self):
+        """ send all buffered text frames as a single frame.
+        """
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        if not self._batch or self.closed:
+            return
+        batch, self._batch = self._batch, []
+        metrics.incr("websockets.batched_frames")
+        metrics.incr("websockets.batched_messages", len(batch))
+        super(ManagedWebSocketResponse, self).send_str(json.dumps(batch))
+
+    @asyncio.coroutine
+    def _beat(self):
+        while not self.closed:
+            if self.ping_interval:
+                yield from asyncio.sleep(self.ping_interval)
+                sent = self._time()
+                self.ping()
+                if self.pong_timeout:
+                    yield from asyncio.sleep(self.pong_timeout)
+                    if self.last_seen < sent:
+                        return (yield from self.reap("no pong received"))
+            else:
+                yield from asyncio.sleep(self.idle_timeout / 2)
+            idle = self._time() - self.last_active
+            if self.idle_timeout and idle > self.idle_timeout:
+                return (yield from self.reap("idle for {0:.0f}s".format(idle)))
+
+    @asyncio.coroutine
+    def reap(self, reason):
+        """ tear down a dead or idle connection.
+        """
+        self.reaped = True
+        metrics.incr("websockets.reaped")
+        logger.info("reaping websocket connection: {0}".format(reason))
+        if self.on_reap is not None:
+            self.on_reap()
+        self._frames.put_nowait(Message(MsgType.closed, None, None))
+        yield from self.close()
+
+    def stop_heartbeat(self):
+        current = asyncio.Task.current_task()
+        tasks = (self._reading,) if self.reaped else (self._reading, self._heartbeat)
+        for task in tasks:
+            if task is not None and task is not current:
+                task.cancel()
+
+    @asyncio.coroutine
+    def close(self, **kwargs):
+        self.flush()
+        self.stop_heartbeat()
+        return (yield from super(ManagedWebSocketResponse, self).close(**kwargs))
+
+
+def _websocket_response(**kwargs):
+    return ManagedWebSocketResponse(
+        ping_interval=REDIS_PUBSUB["websocket_ping_interval"],
+        pong_timeout=REDIS_PUBSUB["websocket_pong_timeout"],
+        idle_timeout=REDIS_PUBSUB["websocket_idle_timeout"],
+        **kwargs)
+
+
+@asyncio.coroutine
+def _run_handler(ws, request, func, *args, **kwargs):
+    """ run a handler as a task that a reaped connection can cancel.
+    """
+    try:
+        yield from ws.prepare(request)
+        handler = ensure_future(func(ws, *args, **kwargs))
+        name = getattr(func, "__name__", func)
+        label_task(handler, "{0} {1}".format(name, request.path))
+        ws.on_reap = handler.cancel
+        yield from handler
+    except asyncio.CancelledError:
+        if not ws.reaped:
+            raise
+    except Exception as err:  # pragma: no cover
+        logger.error(str(err))
+    finally:
+        ws.flush()
+        ws.stop_heartbeat()
+
+
 def _clean_route(route):
     """ ensure that the route can be prefixed with os.path.join and ends with a slash if.
     """
@@ -59,13 +258,8 @@ def websocket(route, authenticate=False):
             if authenticate:
                 kwargs["user"] = handle_auth(params.get("token", None))
 
-            ws = WebSocketResponse()
-            try:
-                yield from ws.prepare(request)
-                yield from func(ws, params, **kwargs)
-            except Exception as err:  # pragma: no cover
-                logger.error(str(err))
-
+            ws = _websocket_response()
+            yield from _run_handler(ws, request, func, params, **kwargs)
             return ws
 
         # cleanup the route
@@ -75,12 +269,17 @@ def websocket(route, authenticate=False):
     return inner
 
 
-def websocket_pubsub(route, authenticate=False):
+def websocket_pubsub(route, authenticate=False, batch=False, batch_size=None,
+                     batch_interval=None):
     """ a wrapper method for transforming a coroutine into a websocket handler with
     a pubsub manager. if `authenticate=False` the signature of your coroutine should be
     `func(ws: WebSocketResponse, params: MultiDict, manager: SubscriptionManager)`
     otherwise an additional keywork argument is available, that being the authenticated
     user making the request.
+
+    with `batch=True` the strings sent with `ws.send_str` within one loop iteration (or
+    within `batch_interval` seconds, up to `batch_size` strings) are delivered to the
+    client as a single frame holding a JSON array of those strings.
     """
     def inner(func):
         func = asyncio.coroutine(func)
@@ -99,12 +298,10 @@ def websocket_pubsub(route, authenticate=False):
             manager = SubscriptionManager(redis_)
 
             kwargs["manager"] = manager
-            ws = WebSocketResponse()
+            ws = _websocket_response(batch=batch, batch_size=batch_size,
+                                     batch_interval=batch_interval)
             try:
-                yield from ws.prepare(request)
-                yield from func(ws, params, **kwargs)
-            except Exception as err:  # pragma: no cover
-                logger.error(str(err))
+                yield from _run_handler(ws, request, func, params, **kwargs)
             finally:
                 yield from manager.stop()
 
@@ -0,0 +1,111 @@
+import asyncio
+import logging
+import sys
+import threading
+import time
+import traceback
+import weakref
+
+from redis_pubsub import REDIS_PUBSUB, metrics
+from redis_pubsub.compat import ensure_future
+
+
+__all__ = (
+    "LoopWatchdog", "label_task"
+    )
+
+
+logger = logging.getLogger(__name__)
+
+# tasks labelled with the handler they run, see `label_task`
+LABELS = weakref.WeakKeyDictionary()
+
+
+def label_task(task, label):
+    """ name the handler or channel that `task` runs, for stall reports.
+    """
+    LABELS[task] = label
+
+
+class LoopWatchdog:
+    """ detects blocking code on the event loop. a heartbeat coroutine records the
+    loop's lag every `interval` seconds as the `loop.lag` gauge, and a thread watches
+    the heartbeat. when the loop has not run the heartbeat for `threshold` seconds, the
+    thread captures the loop thread's stack, the current task's label and the channel
+    being dispatched, logs them as a warning and counts a `loop.stall` in
+    `redis_pubsub.metrics`. each stall is reported once.
+
+    .. code:: python
+
+        watchdog = LoopWatchdog(loop, threshold=0.1).start()
+        ...
+        watchdog.stop()
+    """
+    def __init__(self, loop=None, threshold=None, interval=None):
+        self.loop = loop or asyncio.get_event_loop()
+        self.threshold = threshold or REDIS_PUBSUB["watchdog_threshold"]
+        self.interval = interval or REDIS_PUBSUB["watchdog_interval"]
+        self._beat = None
+        self._reported = None
+        self._thread_id = None
+        self._heartbeat = None
+        self._thread = None
+        self._stopped = threading.Event()
+
+    def start(self):
+        self._heartbeat = ensure_future(self._run_heartbeat(), loop=self.loop)
+        self._thread = threading.Thread(target=self._watch, name="redis_pubsub.watchdog")
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stopped.set()
+        if self._heartbeat is not None:
+            self._heartbeat.cancel()
+
+    @asyncio.coroutine
+    def _run_heartbeat(self):
+        self._thread_id = threading.get_ident()
+        while True:
+            self._beat = time.monotonic()
+            yield from asyncio.sleep(self.interval)
+            lag = time.monotonic() - self._beat - self.interval
+            metrics.gauge("loop.lag", max(lag, 0))
+
+    def _watch(self):
+        while not self._stopped.wait(self.interval):
+            beat = self._beat
+            if beat is None or beat == self._reported:
+                continue
+            lag = time.monotonic() - beat - self.interval
+            if lag > self.threshold:
+                self._reported = beat
+                self.report(lag)
+
+    def report(self, lag):
+        frame = sys._current_frames().get(self._thread_id)
+        stack = "".join(traceback.format_stack(frame)) if frame is not None else ""
+        metrics.incr("loop.stalls")
+        logger.warning("event loop stalled for over {0:.3f}s in {1}\n{2}".format(
+            lag, self.describe(frame), stack))
+
+    def describe(self, frame):
+        """ the label of the task running on the loop, and the channel it is
+        dispatching if any.
+        """
+        task = asyncio.Task.current_task(loop=self.loop)
+        if task is None:
+            description = "a callback"
+        else:
+            coro = getattr(task, "_coro", None)
+            description = LABELS.get(task) or getattr(coro, "__qualname__", repr(task))
+
+        while frame is not None:
+            channel_name = frame.f_locals.get("channel_name")
+            if channel_name is not None:
+                if isinstance(channel_name, bytes):
+                    channel_name = channel_name.decode("utf-8")
+                return "{0} (channel {1})".format(description, channel_name)
+            frame = frame.f_back
+        return description
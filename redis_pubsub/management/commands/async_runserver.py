@@ -5,6 +5,7 @@ from django.core.wsgi import get_wsgi_application
 
 from aiohttp_wsgi import WSGIHandler
 
+from redis_pubsub import REDIS_PUBSUB
 from redis_pubsub.contrib import websockets
 
 
@@ -22,10 +23,16 @@ class Command(BaseCommand):
             "--port", default=8000, type=int,
             help="the port to serve on"
             )
+        parser.add_argument(
+            "--watchdog", default=REDIS_PUBSUB["watchdog_threshold"], type=float,
+            help="report event loop stalls longer than this many seconds"
+            )
 
     def handle(self, *args, **options):
         host = options["host"]
         port = options["port"]
+        if options["watchdog"]:
+            REDIS_PUBSUB["watchdog_threshold"] = options["watchdog"]
 
         print("Prepairing async server ...")
         loop = asyncio.get_event_loop()
@@ -42,4 +49,4 @@ class Command(BaseCommand):
         except KeyboardInterrupt:
             print("Stopping server...")
             server.close()
-            loop.run_until_complete(service.wait_closed())
+            loop.run_until_complete(server.wait_closed())
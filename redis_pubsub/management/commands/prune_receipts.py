@@ -0,0 +1,43 @@
+import datetime
+import time
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from redis_pubsub import REDIS_PUBSUB
+from redis_pubsub.models import ReceivedPublication
+
+
+class Command(BaseCommand):
+    """ delete ReceivedPublications older than a retention period. rows are deleted in
+    bounded batches so the table is never locked for long.
+    """
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--days", default=REDIS_PUBSUB["receipts_retention_days"], type=int,
+            help="delete receipts older than this many days"
+            )
+        parser.add_argument(
+            "--batch-size", default=1000, type=int,
+            help="the number of receipts deleted per query"
+            )
+        parser.add_argument(
+            "--pause", default=0, type=float,
+            help="seconds to wait between batches"
+            )
+
+    def handle(self, *args, **options):
+        cutoff = timezone.now() - datetime.timedelta(days=options["days"])
+        expired = ReceivedPublication.objects.filter(datetime_received__lt=cutoff)
+
+        deleted = 0
+        while True:
+            ids = list(expired.values_list("id", flat=True)[:options["batch_size"]])
+            if not ids:
+                break
+            ReceivedPublication.objects.filter(id__in=ids).delete()
+            deleted += len(ids)
+            if options["pause"]:
+                time.sleep(options["pause"])
+
+        print("Deleted {0} receipts older than {1} days.".format(deleted, options["days"]))
@@ -0,0 +1,50 @@
+import asyncio
+
+from django.core.management.base import BaseCommand
+
+from redis_pubsub import REDIS_PUBSUB
+from redis_pubsub.compat import ensure_future
+from redis_pubsub.models import OutboxPublication
+from redis_pubsub.outbox import relay_batch, run_relay
+
+
+class Command(BaseCommand):
+    """ relay publications written to the outbox to the pubsub backend, see
+    `REDIS_PUBSUB["outbox"]`. runs until interrupted, or with `--once` until no rows are
+    due, rows deferred by a rate limit are left for a later run.
+    """
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--batch-size", default=REDIS_PUBSUB["outbox_batch_size"], type=int,
+            help="the number of publications relayed per transaction"
+            )
+        parser.add_argument(
+            "--interval", default=REDIS_PUBSUB["outbox_interval"], type=float,
+            help="seconds to wait for new publications once the outbox is empty"
+            )
+        parser.add_argument(
+            "--report-interval", default=60, type=float,
+            help="seconds between throughput and lag reports"
+            )
+        parser.add_argument(
+            "--once", action="store_true", default=False,
+            help="relay until no publications are due, then exit"
+            )
+
+    def handle(self, *args, **options):
+        if options["once"]:
+            relayed = 0
+            while OutboxPublication.objects.due().exists():
+                relayed += relay_batch(options["batch_size"])
+            print("Relayed {0} publications, {1} left in the outbox.".format(
+                relayed, OutboxPublication.objects.count()))
+            return
+
+        loop = asyncio.get_event_loop()
+        relay = ensure_future(run_relay(
+            options["batch_size"], options["interval"], options["report_interval"]))
+        try:
+            loop.run_until_complete(relay)
+        except KeyboardInterrupt:
+            relay.cancel()
+            loop.run_until_complete(asyncio.wait([relay]))
@@ -1,5 +1,12 @@
+import json
+
 from django.contrib.contenttypes.models import ContentType
-from django.db.models import manager
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import transaction
+from django.db.models import Q, manager
+from django.utils import timezone
+
+from . import REDIS_PUBSUB
 
 
 class PublishableModelManager(manager.Manager):
@@ -8,7 +15,9 @@ class PublishableModelManager(manager.Manager):
         been delivered to a client. the tuples consist of a subscriber, instance pair.
         """
         from . models import ReceivedPublication
+        from . receipts import get_receipt_store
 
+        receipts = get_receipt_store()
         undelivered = []
         for instance in self.get_queryset().iterator():
             subscriptions = instance.channel.subscribers.select_related("subscriber")
@@ -20,9 +29,94 @@ class PublishableModelManager(manager.Manager):
                                         publication_id=id,
                                         channel=instance.channel,
                                         subscriber__in=subscribers)
-            recieved_by = received.values_list("subscriber_id", flat=True)
+            recieved_by = set(received.values_list("subscriber_id", flat=True))
+            recieved_by |= receipts.received_by(ct, id, instance.channel)
             for subscription in subscriptions.exclude(subscriber_id__in=recieved_by)\
                                 .select_related("subscriber"):
                 undelivered.append((subscription.subscriber, instance))
 
         return undelivered
+
+
+class ChannelManager(manager.Manager):
+    def publish_many(self, model, channels, delta=None):
+        """ publish `model` on many channels, for instance a channel per participant of
+        a conversation. `channels` may be Channel instances or names. the channels that
+        are active or keep a history are found with a single query, and the model is
+        published on all of them in one backend call per shard. returns the number of
+        receivers.
+        """
+        from . import util
+
+        names = set(getattr(channel, "name", channel) for channel in channels)
+        if not names:
+            return 0
+        publishing = self.filter(name__in=names)\
+                         .filter(Q(subscribers__active=True) | Q(history_length__gt=0))\
+                         .values_list("name", "history_length")\
+                         .distinct()
+        history = dict(publishing)
+        if not history:
+            return 0
+        message = self.model.get_publication(model, delta)
+        receivers = util.redis_channel_publish_many(sorted(history), message,
+                                                    history=history)
+        if REDIS_PUBSUB["offline_queue"]:
+            self.queue_offline(sorted(history), message)
+        return receivers
+
+    def queue_offline(self, names, message):
+        """ queue `message` for the active subscribers of the channels `names` that are
+        not connected, with one query for the subscribers and a single insert.
+        """
+        from . import util
+        from .models import QueuedPublication, Subscription
+
+        subscriptions = Subscription.objects.filter(channel__name__in=names, active=True)\
+                                            .values_list("channel_id", "channel__name",
+                                                         "subscriber_id")
+        present = {}
+        queued = []
+        body = json.dumps(message, cls=DjangoJSONEncoder)
+        for channel_id, name, subscriber_id in subscriptions:
+            if name not in present:
+                present[name] = util.get_present_subscribers(name)
+            if subscriber_id not in present[name]:
+                queued.append(QueuedPublication(subscriber_id=subscriber_id,
+                                                channel_id=channel_id, message=body))
+        QueuedPublication.objects.bulk_create(queued, batch_size=1000)
+
+
+class QueuedPublicationManager(manager.Manager):
+    def drain(self, subscriber_id, channel_id):
+        """ delete and return the serialized publications queued for a subscriber on a
+        channel, oldest first.
+        """
+        return self.drain_many(subscriber_id, [channel_id]).get(channel_id, [])
+
+    def drain_many(self, subscriber_id, channel_ids):
+        """ delete and return the serialized publications queued for a subscriber on
+        many channels in one transaction, as a dict of channel ids to publications,
+        oldest first.
+        """
+        with transaction.atomic():
+            queued = list(self.filter(subscriber_id=subscriber_id,
+                                      channel_id__in=channel_ids)
+                              .select_for_update()
+                              .order_by("id")
+                              .values_list("id", "channel_id", "message"))
+            if queued:
+                self.filter(id__in=[id_ for id_, _, _ in queued]).delete()
+        drained = {}
+        for _, channel_id, message in queued:
+            drained.setdefault(channel_id, []).append(message)
+        return drained
+
+
+class OutboxPublicationManager(manager.Manager):
+    def due(self, now=None):
+        """ the rows that may be relayed now, rows deferred by a rate limit are left out
+        until their `not_before` time.
+        """
+        now = now or timezone.now()
+        return self.filter(Q(not_before__isnull=True) | Q(not_before__lte=now))
@@ -0,0 +1,42 @@
+import collections
+import threading
+
+
+__all__ = (
+    "incr", "gauge", "get", "snapshot", "reset"
+    )
+
+
+_lock = threading.Lock()
+COUNTERS = collections.Counter()
+
+
+def incr(name, value=1):
+    """ increment the process wide counter `name` by `value`
+    """
+    with _lock:
+        COUNTERS[name] += value
+
+
+def gauge(name, value):
+    """ set `name` to `value`, for measurements such as a lag or a rate that are not
+    counted.
+    """
+    with _lock:
+        COUNTERS[name] = value
+
+
+def get(name):
+    return COUNTERS[name]
+
+
+def snapshot():
+    """ returns a copy of all counters, suitable for exporting to a metrics system.
+    """
+    with _lock:
+        return dict(COUNTERS)
+
+
+def reset():
+    with _lock:
+        COUNTERS.clear()
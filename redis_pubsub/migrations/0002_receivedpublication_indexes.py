@@ -0,0 +1,23 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('redis_pubsub', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='receivedpublication',
+            name='datetime_received',
+            field=models.DateTimeField(auto_now_add=True, db_index=True),
+        ),
+        migrations.AlterIndexTogether(
+            name='receivedpublication',
+            index_together=set([('publication_type', 'publication_id', 'channel', 'subscriber')]),
+        ),
+    ]
@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('redis_pubsub', '0002_receivedpublication_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='channel',
+            name='history_length',
+            field=models.PositiveIntegerField(default=0),
+        ),
+    ]
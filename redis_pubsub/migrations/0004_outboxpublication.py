@@ -0,0 +1,24 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('redis_pubsub', '0003_channel_history_length'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='OutboxPublication',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('channel', models.CharField(max_length=100)),
+                ('message', models.TextField()),
+                ('history', models.PositiveIntegerField(default=0)),
+                ('datetime_created', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+    ]
@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('redis_pubsub', '0005_queuedpublication'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='outboxpublication',
+            name='not_before',
+            field=models.DateTimeField(blank=True, db_index=True, null=True),
+        ),
+    ]
@@ -1,17 +1,24 @@
+import hashlib
+import json
+
 from django.conf import settings
 from django.contrib.auth import get_user_model
 from django.contrib.contenttypes.models import ContentType
 from django.contrib.contenttypes.fields import GenericForeignKey
 from django.core import serializers
-from django.db import models
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import IntegrityError, models, transaction
 
+from . import REDIS_PUBSUB
 from . import util
 from . import managers
+from .cache import serialized
 
 user_model = settings.AUTH_USER_MODEL
 
 __all__ = (
-    "PublishableModel", "Channel", "Subscription", "ReceivedPublication"
+    "PublishableModel", "Channel", "Subscription", "ReceivedPublication",
+    "OutboxPublication", "QueuedPublication"
     )
 
 
@@ -25,6 +32,23 @@ class PublishableModel(models.Model):
     """
     PUBLISH_ON_CREATE = False
     PUBLISH_ON_UPDATE = False
+    # a field that changes whenever the published state of the model changes, such as
+    # an `auto_now` timestamp. when unset, a digest of the concrete fields is used.
+    PUBLISH_VERSION_FIELD = None
+    # cheap, json serializable attributes sent with every publication, such as
+    # `("author_id",)`. readers can filter on these without fetching the model.
+    PUBLISH_FILTER_FIELDS = ()
+    # hints applied when a reader fetches a published model, so that relations used
+    # in callbacks are loaded with the model rather than lazily per delivery.
+    PUBLISH_SELECT_RELATED = ()
+    PUBLISH_PREFETCH = ()
+    PUBLISH_ONLY = ()
+    # publish the fields changed by an update along with the pk, readers registered
+    # with `ChannelReader.on_delta` receive them without fetching the model.
+    PUBLISH_DELTA = False
+    # the fields whose changes are published, updates that change none of them are not
+    # published. defaults to every concrete field.
+    PUBLISH_TRACKED_FIELDS = None
 
     channel = models.ForeignKey("Channel", related_name="publishable_%(class)ss")
     objects = managers.PublishableModelManager()
@@ -35,18 +59,109 @@ class PublishableModel(models.Model):
     def subscribe(self, *subscribers):  # pragma: no cover
         """ Create a subscription to this models channel for each of the `subscribers`
         """
-        for subscriber in subscribers:
-            self.channel.subscribe(subscriber)
+        self.channel.subscribe_many(subscribers)
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super(PublishableModel, cls).from_db(db, field_names, values)
+        instance.take_publish_snapshot()
+        return instance
 
-    def publish(self):  # pragma: no cover
+    def publish(self, delta=None):  # pragma: no cover
         """ publish this model on its channel
         """
-        self.channel.publish(self)
+        self.channel.publish(self, delta=delta)
+
+    def get_tracked_attnames(self, fields=None):
+        """ the attnames of `fields`, or of `PUBLISH_TRACKED_FIELDS`, or of every
+        concrete field.
+        """
+        fields = fields if fields is not None else self.PUBLISH_TRACKED_FIELDS
+        if fields is None:
+            return [f.attname for f in self._meta.concrete_fields]
+        return [self._meta.get_field(name).attname for name in fields]
+
+    def get_publish_state(self, fields=None):
+        """ the loaded values of the tracked fields, deferred fields are skipped.
+        """
+        return {name: self.__dict__[name] for name in self.get_tracked_attnames(fields)
+                if name in self.__dict__}
 
-    def serialize(self):  # pragma: no cover
-        """ a generic serialization method for all publishable models
+    def take_publish_snapshot(self, update_fields=None):
+        """ remember the current state, `get_dirty_fields` reports changes against it.
+        called when the model is loaded and after it is saved, only `update_fields` are
+        refreshed when they are given.
+        """
+        snapshot = getattr(self, "_publish_snapshot", None)
+        if update_fields is None or snapshot is None:
+            self._publish_snapshot = self.get_publish_state()
+        else:
+            snapshot.update(self.get_publish_state(update_fields))
+
+    def get_dirty_fields(self, update_fields=None):
+        """ returns the tracked fields, by attname, that changed since the model was
+        loaded or last saved, limited to `update_fields` when they are given. returns
+        None when the model has no snapshot, i.e. it was neither loaded from nor saved
+        to the database.
+        """
+        snapshot = getattr(self, "_publish_snapshot", None)
+        if snapshot is None:
+            return None
+        state = self.get_publish_state()
+        if update_fields is not None:
+            names = set(self.get_tracked_attnames(update_fields))
+            state = {name: value for name, value in state.items() if name in names}
+        return {name: value for name, value in state.items()
+                if name not in snapshot or snapshot[name] != value}
+
+    @classmethod
+    def get_publish_queryset(cls):
+        """ returns the queryset readers fetch published instances from, applying
+        `PUBLISH_SELECT_RELATED`, `PUBLISH_PREFETCH` and `PUBLISH_ONLY`.
+        """
+        queryset = cls.objects.all()
+        if cls.PUBLISH_SELECT_RELATED:
+            queryset = queryset.select_related(*cls.PUBLISH_SELECT_RELATED)
+        if cls.PUBLISH_PREFETCH:
+            queryset = queryset.prefetch_related(*cls.PUBLISH_PREFETCH)
+        if cls.PUBLISH_ONLY:
+            queryset = queryset.only(*cls.PUBLISH_ONLY)
+        return queryset
+
+    def get_publish_version(self):
+        """ returns a marker that changes whenever the published state of this model
+        changes.
+        """
+        if self.PUBLISH_VERSION_FIELD is not None:
+            return str(getattr(self, self.PUBLISH_VERSION_FIELD))
+        # deferred fields are skipped rather than loaded, see `PUBLISH_ONLY`
+        deferred = self.get_deferred_fields()
+        values = [(f.attname, getattr(self, f.attname))
+                  for f in self._meta.concrete_fields if f.attname not in deferred]
+        return hashlib.md5(repr(values).encode("utf-8")).hexdigest()
+
+    def get_publish_attrs(self):
+        """ returns the `PUBLISH_FILTER_FIELDS` of this model, sent with its publications
+        """
+        return {name: getattr(self, name) for name in self.PUBLISH_FILTER_FIELDS}
+
+    def serialize(self):
+        """ a generic serialization method for all publishable models. serializations
+        are cached per process, so an instance published to many subscribers is only
+        serialized once. an instance with deferred fields, see `PUBLISH_ONLY`, is
+        serialized with the fields that were loaded rather than loading the rest, and
+        is cached per set of loaded fields.
         """
-        return serializers.serialize("json", [self])
+        deferred = self.get_deferred_fields()
+        fields = None
+        if deferred:
+            fields = tuple(f.name for f in self._meta.concrete_fields
+                           if f.attname not in deferred and not f.primary_key)
+            fields += tuple(f.name for f in self._meta.many_to_many)
+        label = "{0}.{1}".format(self._meta.app_label, self._meta.model_name)
+        key = label, self.pk, self.get_publish_version(), fields
+        return serialized.get_or_set(
+            key, lambda: serializers.serialize("json", [self], fields=fields))
 
 
 class Channel(models.Model):
@@ -58,6 +173,11 @@ class Channel(models.Model):
     """
     name = models.CharField(max_length=100, unique=True)
     datetime_created = models.DateTimeField(auto_now_add=True)
+    # the number of recent publications kept for backfilling new readers, see
+    # `ChannelReader.history`
+    history_length = models.PositiveIntegerField(default=0)
+
+    objects = managers.ChannelManager()
 
     def __str__(self):
         return "<Channel(name={0}, active={1})>".format(self.name, self.active)
@@ -78,19 +198,103 @@ class Channel(models.Model):
         model.save()
         return model
 
-    def publish(self, model):
+    def subscribe_many(self, subscribers):
+        """ subscribe, or reactivate the subscriptions of, many subscribers at once. this
+        runs a constant number of queries regardless of the number of subscribers.
+        `subscribers` may be instances of AUTH_USER_MODEL or their primary keys.
+        """
+        ids = set(getattr(subscriber, "pk", subscriber) for subscriber in subscribers)
+        if not ids:
+            return
+
+        with transaction.atomic():
+            existing = self._subscribed_ids(ids)
+            try:
+                with transaction.atomic():
+                    self._create_subscriptions(ids - existing)
+            except IntegrityError:
+                # subscriptions were created concurrently, retry with what remains
+                existing = self._subscribed_ids(ids)
+                self._create_subscriptions(ids - existing)
+            if existing:
+                self.subscribers.filter(subscriber_id__in=existing, active=False)\
+                                .update(active=True)
+        self._clear_subscriber_cache()
+
+    def unsubscribe_many(self, subscribers):
+        """ deactivate the subscriptions of many subscribers with a single query. returns
+        the number of subscriptions that were deactivated.
+        """
+        ids = set(getattr(subscriber, "pk", subscriber) for subscriber in subscribers)
+        if not ids:
+            return 0
+        count = self.subscribers.filter(subscriber_id__in=ids, active=True)\
+                                .update(active=False)
+        self._clear_subscriber_cache()
+        return count
+
+    def _subscribed_ids(self, ids):
+        queryset = self.subscribers.filter(subscriber_id__in=ids)
+        return set(queryset.values_list("subscriber_id", flat=True))
+
+    def _create_subscriptions(self, ids):
+        subscriptions = [Subscription(subscriber_id=id_, channel=self) for id_ in ids]
+        Subscription.objects.bulk_create(subscriptions, batch_size=1000)
+
+    def _clear_subscriber_cache(self):
+        """ forget subscriptions that were prefetched with this channel.
+        """
+        cache = getattr(self, "_prefetched_objects_cache", {})
+        cache.pop("subscribers", None)
+
+    @staticmethod
+    def get_publication(model, delta=None):
         """ reduces the model into a json serializable dict that can be recovered by a
         subscriber coroutine.
         """
-        if self.active:  # pragma: no branch
-            klass = type(model)
-            # make this model json serializable / recoverable
-            kwargs = {
-                "app_label": klass._meta.app_label,
-                "object_name": klass._meta.object_name,
-                "pk": model.pk
-                }
-            util.redis_channel_publish(self.name, kwargs)
+        klass = type(model)
+        # make this model json serializable / recoverable
+        kwargs = {
+            "app_label": klass._meta.app_label,
+            "object_name": klass._meta.object_name,
+            "pk": model.pk
+            }
+        get_attrs = getattr(model, "get_publish_attrs", None)
+        attrs = get_attrs() if get_attrs is not None else None
+        if attrs:
+            kwargs["attrs"] = attrs
+        get_version = getattr(model, "get_publish_version", None)
+        if get_version is not None:
+            kwargs["version"] = get_version()
+        if delta:
+            kwargs["delta"] = delta
+        return kwargs
+
+    def publish(self, model, delta=None):
+        """ publish the model on this channel. `delta` is an optional dict of changed
+        fields published with the model, see `PublishableModel.PUBLISH_DELTA`. channels
+        with a `history_length` are published to whether or not they are active, so
+        that the history is kept.
+        """
+        if self.history_length or self.active:  # pragma: no branch
+            kwargs = self.get_publication(model, delta)
+            util.redis_channel_publish(self.name, kwargs, history=self.history_length)
+            if REDIS_PUBSUB["offline_queue"]:
+                self.queue_offline(kwargs)
+
+    def queue_offline(self, message):
+        """ queue `message` for each active subscriber that is not connected to this
+        channel, with a single insert.
+        """
+        subscribers = self.subscribers.filter(active=True)\
+                                      .values_list("subscriber_id", flat=True)
+        offline = set(subscribers) - util.get_present_subscribers(self.name)
+        if offline:
+            body = json.dumps(message, cls=DjangoJSONEncoder)
+            QueuedPublication.objects.bulk_create([
+                QueuedPublication(subscriber_id=id_, channel=self, message=body)
+                for id_ in offline
+                ], batch_size=1000)
 
 
 class Subscription(models.Model):
@@ -165,51 +369,73 @@ class ReceivedPublication(models.Model):
             ).values_list("publication_id", flat=True)
         not_received = Message.objects.exclude(id__in=received)
 
-    it may be wise in your application to create an additional utility model that acts
-    as a queue for undelivered publications.
-
-    .. code:: python
-
-        class QueuedPublication(models.Model):
-            subscriber = models.ForeignKey(settings.AUTH_USER_MODEL,
-                                            related_name="queued_publications")
-            publication_type = models.ForeignKey(ContentType, null=True)
-            publication_id = models.PositiveIntegerField(null=True)
-            publication = GenericForeignKey("publication_type", "publication_id")
-
-            @classmethod
-            def find_all_undelivered(cls):
-                queue = []
-                for publishable in PublishableModel.__subclasses__():
-                    for instance in publishable.objects\
-                                            .select_related("channel")\
-                                            .prefetch_related("channel__subscribers"):
-                        channel = instance.channel
-                        subscribers = channel.subscribers.all()
-                        received = ReceivedPublication.objects.filter(
-                            publication=instance, channel=message.channel,
-                            subscriber__in=subscribers
-                            ).values_list("subscriber_id", flat=True)
-                        not_received_by = subscribers.exclude(id__in=received_by)
-                        for subscriber in not_received_by:
-                            queued = cls(subscriber=subscriber, publication=instance)
-                            queue.append(queued)
-                cls.objects.bulk_create(queue)
-
-    the preceeding model could run its `find_all_undelivered` method in a cronjob, and
-    perhaps, deliver all of the publications the next time the subscriber is connected.
-    of course, this code would have to be cleaned up as it inherently allows for a
-    massive amount of duplication.
+    publications for subscribers that are not connected can also be queued as they are
+    published, see `QueuedPublication`.
     """
     channel = models.ForeignKey("Channel", related_name="publications")
     subscriber = models.ForeignKey(user_model, related_name="received_publications")
-    datetime_received = models.DateTimeField(auto_now_add=True, editable=False)
+    datetime_received = models.DateTimeField(auto_now_add=True, editable=False,
+                                             db_index=True)
 
     publication_type = models.ForeignKey(ContentType, null=True)
     publication_id = models.PositiveIntegerField(null=True)
     publication = GenericForeignKey("publication_type", "publication_id")
 
+    class Meta:
+        # supports the lookup performed by `PublishableModelManager.get_undelivered`
+        index_together = [
+            ("publication_type", "publication_id", "channel", "subscriber"),
+            ]
+
     def __str__(self):
         args = self.channel.name, str(self.publication), str(self.subscriber)
         return "<ReceivedPublication(channel_name={0}, publication={1}) for "\
                     "{2}>".format(*args)
+
+
+class OutboxPublication(models.Model):
+    """ a serialized publication waiting to be relayed to the pubsub backend. with
+    `REDIS_PUBSUB["outbox"]` publications are written here in the publishing
+    transaction, so a save does not depend on redis being available and a publication
+    is not lost if the process dies. the `relay_outbox` command publishes and deletes
+    them, see `redis_pubsub.outbox`.
+    """
+    channel = models.CharField(max_length=100)
+    message = models.TextField()
+    history = models.PositiveIntegerField(default=0)
+    datetime_created = models.DateTimeField(auto_now_add=True)
+    # throttled rows are kept in the outbox, and not relayed again, until this time
+    not_before = models.DateTimeField(null=True, blank=True, db_index=True)
+
+    objects = managers.OutboxPublicationManager()
+
+    def __str__(self):
+        return "<OutboxPublication(channel={0})>".format(self.channel)
+
+
+class QueuedPublication(models.Model):
+    """ a publication queued for a subscriber that was not connected to the channel
+    when it was published. with `REDIS_PUBSUB["offline_queue"]`, `Channel.publish`
+    queues publications for active subscribers without a listening reader, and a
+    `ChannelReader` delivers and deletes its subscriber's queue when it connects.
+
+    .. code:: python
+
+        # publications waiting for a subscriber
+        subscriber.queued_publications.select_related("channel")
+    """
+    subscriber = models.ForeignKey(user_model, related_name="queued_publications")
+    channel = models.ForeignKey("Channel", related_name="queued_publications")
+    message = models.TextField()
+    datetime_queued = models.DateTimeField(auto_now_add=True)
+
+    objects = managers.QueuedPublicationManager()
+
+    class Meta:
+        index_together = [
+            ("subscriber", "channel"),
+            ]
+
+    def __str__(self):
+        return "<QueuedPublication(channel_name={0}) for {1}>".format(
+            self.channel.name, str(self.subscriber))
@@ -0,0 +1,159 @@
+import asyncio
+import collections
+import datetime
+import json
+import logging
+import time
+
+from django.db import transaction
+from django.utils import timezone
+
+from . import REDIS_PUBSUB, metrics
+from .ratelimit import get_limit, handle_throttled
+
+
+__all__ = (
+    "enqueue", "enqueue_many", "relay_batch", "run_relay"
+    )
+
+
+logger = logging.getLogger(__name__)
+
+
+def enqueue(channel, message, history=0):
+    """ write a serialized message to the outbox, in the current transaction.
+    """
+    from .models import OutboxPublication
+    OutboxPublication.objects.create(channel=channel, message=message, history=history)
+    return 0
+
+
+def enqueue_many(channels, message, history=None):
+    from .models import OutboxPublication
+    history = history or {}
+    OutboxPublication.objects.bulk_create([
+        OutboxPublication(channel=channel, message=message,
+                          history=history.get(channel, 0))
+        for channel in channels
+        ])
+    return 0
+
+
+def relay_batch(batch_size=None, backend=None):
+    """ claim up to `batch_size` of the oldest outbox rows that are due, publish them in
+    one backend call and delete them, all in one transaction. rows are locked while
+    they are relayed, and if publishing fails they stay in the outbox to be retried.
+
+    rate limits apply as they do to direct publications, except that throttled rows
+    are never waited on while the batch holds its locks, and do not leave the table
+    until they are published. rows throttled by the `"delay"` and `"coalesce"`
+    policies stay in the outbox with a `not_before` time, when the channel has tokens
+    again. on coalescing channels only the latest row per publication key is kept,
+    older rows with the same key are deleted. returns the number of rows relayed,
+    dropped or coalesced.
+    """
+    from .models import OutboxPublication
+    from .util import coalesce_key, get_backend
+
+    batch_size = batch_size or REDIS_PUBSUB["outbox_batch_size"]
+    backend = backend or get_backend()
+    with transaction.atomic():
+        now = timezone.now()
+        rows = list(OutboxPublication.objects.due(now)
+                                             .select_for_update()
+                                             .order_by("id")[:batch_size])
+        if not rows:
+            return 0
+        limits = {channel: get_limit(channel) for channel in set(r.channel for r in rows)}
+        coalescing = [channel for channel, limit in limits.items()
+                      if limit is not None and limit[2] == "coalesce"]
+        # the ids of coalesced rows left by earlier batches, per publication key
+        waiting = collections.defaultdict(set)
+        if coalescing:
+            for row in OutboxPublication.objects.filter(channel__in=coalescing,
+                                                        not_before__gt=now) \
+                                                .select_for_update():
+                key = coalesce_key(row.channel, json.loads(row.message))
+                waiting[row.channel, key].add(row.id)
+
+        publications, done, superseded = [], [], []
+        deferred = collections.defaultdict(list)
+        coalesced = collections.OrderedDict()
+        for row in rows:
+            limit = limits[row.channel]
+            if row.channel in coalescing:
+                key = row.channel, coalesce_key(row.channel, json.loads(row.message))
+                if any(id_ > row.id for id_ in waiting[key]):
+                    superseded.append(row.id)
+                    continue
+                superseded.extend(waiting.pop(key, ()))
+                if key in coalesced:
+                    superseded.append(coalesced.pop(key)[0].id)
+            if limit is not None:
+                allowed, wait = backend.take_token(row.channel, *limit[:2])
+                policy, max_delay = limit[2:]
+                if not allowed and policy == "coalesce":
+                    coalesced[key] = row, wait
+                    continue
+                if not allowed and policy == "delay" and wait <= max_delay:
+                    deferred[now + datetime.timedelta(seconds=wait)].append(row.id)
+                    continue
+                if not allowed:
+                    handle_throttled(backend, row.channel, row.message, limit, wait,
+                                     history=row.history)
+                    done.append(row)
+                    continue
+            publications.append((row.channel, row.message, row.history))
+            done.append(row)
+        for row, wait in coalesced.values():
+            deferred[now + datetime.timedelta(seconds=wait)].append(row.id)
+
+        if publications:
+            backend.publish_batch(publications)
+        OutboxPublication.objects.filter(
+            id__in=[row.id for row in done] + superseded).delete()
+        for not_before, ids in deferred.items():
+            metrics.incr("outbox.deferred", len(ids))
+            OutboxPublication.objects.filter(id__in=ids).update(not_before=not_before)
+
+    if superseded:
+        metrics.incr("outbox.coalesced", len(superseded))
+    if done:
+        metrics.incr("outbox.relayed", len(done))
+        lag = timezone.now() - min(row.datetime_created for row in done)
+        metrics.gauge("outbox.lag", lag.total_seconds())
+    return len(done) + len(superseded)
+
+
+@asyncio.coroutine
+def run_relay(batch_size=None, interval=None, report_interval=60):
+    """ relay the outbox until cancelled. batches are relayed in the loop's executor,
+    back to back while the outbox is full and every `interval` seconds once it is
+    drained. the throughput and the lag of the oldest relayed row are logged every
+    `report_interval` seconds and kept in `redis_pubsub.metrics` as the
+    `outbox.throughput` and `outbox.lag` gauges.
+    """
+    from .util import run_in_executor
+
+    batch_size = batch_size or REDIS_PUBSUB["outbox_batch_size"]
+    interval = interval or REDIS_PUBSUB["outbox_interval"]
+    relayed, started = 0, time.monotonic()
+    while True:
+        try:
+            count = yield from run_in_executor(relay_batch, batch_size)
+        except asyncio.CancelledError:
+            raise
+        except Exception as err:
+            logger.error("relaying the outbox failed: {0}".format(err))
+            count = 0
+
+        relayed += count
+        elapsed = time.monotonic() - started
+        if elapsed >= report_interval:
+            metrics.gauge("outbox.throughput", relayed / elapsed)
+            logger.info("relayed {0} publications, {1:.1f}/s, lag {2:.3f}s".format(
+                relayed, relayed / elapsed, metrics.get("outbox.lag")))
+            relayed, started = 0, time.monotonic()
+
+        if count < batch_size:
+            yield from asyncio.sleep(interval)
@@ -0,0 +1,286 @@
+import asyncio
+import collections
+import logging
+
+from . import REDIS_PUBSUB
+from .backends import BaseBackend, LocalChannel
+from .compat import ensure_future
+
+
+__all__ = (
+    "ConnectionPool", "PooledConnection", "Lease"
+    )
+
+
+logger = logging.getLogger(__name__)
+
+
+class PooledConnection:
+    """ a single backend subscriber connection shared by many leases. every channel is
+    subscribed on the backend once, and its messages are dispatched locally to each
+    lease that is listening on the channel. if the backend drops a channel, the channel
+    is resubscribed with an exponential backoff.
+    """
+    def __init__(self, pool, backend):
+        self.pool = pool
+        self.backend = backend
+        self.channels = {}
+        self._shards = {}
+        self._counts = collections.Counter()
+        self._pumps = {}
+        self._pending = {}
+
+    def has_capacity(self, shard):
+        return self._counts[shard] < self.pool.max_channels
+
+    def holds(self, name):
+        """ whether `name` is subscribed, or being subscribed, on this connection.
+        """
+        return name in self.channels or name in self._pending
+
+    @property
+    def idle(self):
+        return not self.channels and not self._pending
+
+    @asyncio.coroutine
+    def subscribe(self, name, local):
+        """ dispatch `name` to `local`. while the channel is being subscribed on the
+        backend, later subscribers wait for that subscription rather than being
+        registered on a channel that may yet fail.
+        """
+        while name not in self.channels:
+            pending = self._pending.get(name)
+            if pending is None:
+                yield from self._subscribe(name)
+            else:
+                yield from asyncio.shield(pending)
+        self.channels[name].add(local)
+
+    @asyncio.coroutine
+    def _subscribe(self, name):
+        pending = self._pending[name] = asyncio.Future()
+        self._track(name)
+        try:
+            channel = (yield from self.backend.subscribe(name))[0]
+        except asyncio.CancelledError:
+            # waiting subscribers retry the subscription themselves.
+            self._untrack(name)
+            pending.set_result(None)
+            raise
+        except Exception as err:
+            self._untrack(name)
+            pending.set_exception(err)
+            pending.exception()  # raised to the waiters, if there are any
+            raise
+        finally:
+            del self._pending[name]
+        self.channels[name] = set()
+        self._pumps[name] = ensure_future(self._pump(name, channel))
+        pending.set_result(None)
+
+    def _track(self, name):
+        shard = self._shards[name] = self.pool.shard_for(name)
+        self._counts[shard] += 1
+
+    def _untrack(self, name):
+        shard = self._shards.pop(name, None)
+        self._counts[shard] -= 1
+
+    def detach(self, name, local):
+        """ stop dispatching to `local`, returns True if the channel has no listeners
+        left and should be unsubscribed from the backend.
+        """
+        local.close()
+        listeners = self.channels.get(name)
+        if listeners is None:
+            return False
+        listeners.discard(local)
+        if listeners:
+            return False
+        del self.channels[name]
+        self._untrack(name)
+        pump = self._pumps.pop(name, None)
+        if pump is not None:
+            pump.cancel()
+        return True
+
+    @asyncio.coroutine
+    def unsubscribe(self, name, local):
+        if self.detach(name, local) and not self.backend.closed:
+            yield from self.backend.unsubscribe(name)
+
+    @asyncio.coroutine
+    def _pump(self, name, channel):
+        while True:
+            while (yield from channel.wait_message()):
+                message = yield from channel.get()
+                for local in list(self.channels.get(name, ())):
+                    local.put_nowait(message)
+            if name not in self.channels or self.backend.closed:
+                return
+            channel = yield from self._resubscribe(name)
+
+    @asyncio.coroutine
+    def _resubscribe(self, name):
+        delay, max_delay = self.pool.backoff
+        while True:
+            try:
+                return (yield from self.backend.subscribe(name))[0]
+            except asyncio.CancelledError:
+                raise
+            except Exception as err:
+                logger.warning("resubscribing to {0} failed, retrying in {1}s: {2}"
+                               .format(name, delay, err))
+                yield from asyncio.sleep(delay)
+                delay = min(delay * 2, max_delay)
+
+    def close(self):
+        for pump in self._pumps.values():
+            pump.cancel()
+        for listeners in self.channels.values():
+            for local in listeners:
+                local.close()
+        self.channels.clear()
+        self._shards.clear()
+        self._counts.clear()
+        self._pumps.clear()
+        self.backend.close()
+
+
+class Lease(BaseBackend):
+    """ a view of the pool handed to a single `SubscriptionManager`. a lease has the
+    backend interface, closing it unsubscribes its channels and returns the shared
+    connections to the pool without closing them.
+    """
+    def __init__(self, pool):
+        self.pool = pool
+        self._channels = {}
+        self._closing = None
+        self._closed = False
+
+    def shard_for(self, channel):
+        return self.pool.shard_for(channel)
+
+    def publish(self, channel, message, history=0):
+        return self.pool.router.publish(channel, message, history=history)
+
+    def publish_many(self, channels, message, history=None, limits=None):
+        return self.pool.router.publish_many(channels, message, history=history,
+                                             limits=limits)
+
+    def publish_batch(self, publications):
+        return self.pool.router.publish_batch(publications)
+
+    def history(self, channel, count):
+        return self.pool.router.history(channel, count)
+
+    def set_presence(self, channel, members, ttl):
+        return self.pool.router.set_presence(channel, members, ttl)
+
+    def set_presence_many(self, presences, ttl):
+        return self.pool.router.set_presence_many(presences, ttl)
+
+    def clear_presence(self, channel, members):
+        return self.pool.router.clear_presence(channel, members)
+
+    def get_presence(self, channel):
+        return self.pool.router.get_presence(channel)
+
+    def take_token(self, channel, rate, burst):
+        return self.pool.router.take_token(channel, rate, burst)
+
+    @asyncio.coroutine
+    def subscribe(self, *channels):
+        subscribed = []
+        for name in channels:
+            if name in self._channels:
+                subscribed.append(self._channels[name][1])
+                continue
+            connection = self.pool.acquire(name)
+            local = LocalChannel(name)
+            self._channels[name] = connection, local
+            try:
+                yield from connection.subscribe(name, local)
+            except Exception:
+                self._channels.pop(name, None)
+                self.pool.release(connection)
+                raise
+            subscribed.append(local)
+        return subscribed
+
+    @asyncio.coroutine
+    def unsubscribe(self, *channels):
+        for name in channels:
+            connection, local = self._channels.pop(name, (None, None))
+            if connection is not None:
+                yield from connection.unsubscribe(name, local)
+                self.pool.release(connection)
+
+    @property
+    def closed(self):
+        return self._closed
+
+    def close(self):
+        if not self._closed:
+            self._closed = True
+            self._closing = ensure_future(self.unsubscribe(*list(self._channels)))
+
+    @asyncio.coroutine
+    def wait_closed(self):
+        if self._closing is not None:
+            yield from self._closing
+
+
+class ConnectionPool:
+    """ a pool of backend subscriber connections. each connection holds at most
+    `REDIS_PUBSUB["pool_max_channels"]` channels per shard, and a channel that is
+    already subscribed on a pooled connection is shared rather than subscribed again.
+
+    .. code:: python
+
+        pool = ConnectionPool(create_backend)
+        lease = pool.lease()
+        channel = (yield from lease.subscribe("username:messages"))[0]
+        ...
+        lease.close()  # the pooled connection stays open
+    """
+    def __init__(self, backend_factory, max_channels=None, backoff=None):
+        self.backend_factory = backend_factory
+        self.max_channels = max_channels or REDIS_PUBSUB["pool_max_channels"]
+        self.backoff = backoff or REDIS_PUBSUB["pool_reconnect_backoff"]
+        self.router = backend_factory()
+        self.connections = []
+
+    def shard_for(self, channel):
+        return self.router.shard_for(channel)
+
+    def lease(self):
+        return Lease(self)
+
+    def acquire(self, name):
+        """ returns the pooled connection that `name` should be subscribed on.
+        """
+        for connection in self.connections:
+            if connection.holds(name):
+                return connection
+        shard = self.shard_for(name)
+        for connection in self.connections:
+            if connection.has_capacity(shard):
+                return connection
+        connection = PooledConnection(self, self.backend_factory())
+        self.connections.append(connection)
+        return connection
+
+    def release(self, connection):
+        """ close `connection` once it is idle, as long as another connection remains
+        in the pool.
+        """
+        if connection.idle and len(self.connections) > 1 and \
+                connection in self.connections:
+            self.connections.remove(connection)
+            connection.close()
+
+    def close(self):
+        for connection in self.connections:
+            connection.close()
+        self.connections = []
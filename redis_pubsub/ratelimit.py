@@ -0,0 +1,187 @@
+import collections
+import threading
+import time
+
+from . import REDIS_PUBSUB, metrics
+
+
+__all__ = (
+    "TAKE_TOKEN_FUNCTION", "TOKEN_BUCKET_SCRIPT", "TokenBucket", "get_limit",
+    "throttled_publish", "handle_throttled"
+    )
+
+
+# a lua function that takes `cost` tokens from the bucket at `key`, which is refilled
+# at `rate` tokens per second up to `burst` tokens. returns whether the tokens were
+# taken and, if they were not, the seconds until enough tokens are available.
+TAKE_TOKEN_FUNCTION = """
+local function take_token(key, rate, burst, now, cost)
+    local bucket = redis.call("HMGET", key, "tokens", "timestamp")
+    local tokens = tonumber(bucket[1]) or burst
+    local timestamp = tonumber(bucket[2]) or now
+    tokens = math.min(burst, tokens + math.max(0, now - timestamp) * rate)
+    local allowed = 0
+    local wait = 0
+    if tokens >= cost then
+        tokens = tokens - cost
+        allowed = 1
+    else
+        wait = (cost - tokens) / rate
+    end
+    redis.call("HMSET", key, "tokens", tostring(tokens), "timestamp", tostring(now))
+    redis.call("EXPIRE", key, math.ceil(burst / rate) + 1)
+    return allowed, wait
+end
+"""
+
+# KEYS[1] is the bucket, ARGV is the refill rate in tokens per second, the burst size,
+# the current time and the cost of the publication.
+TOKEN_BUCKET_SCRIPT = TAKE_TOKEN_FUNCTION + """
+local allowed, wait = take_token(KEYS[1], tonumber(ARGV[1]), tonumber(ARGV[2]),
+                                 tonumber(ARGV[3]), tonumber(ARGV[4]))
+return {allowed, tostring(wait)}
+"""
+
+
+def bucket_key(channel):
+    return "redis_pubsub:ratelimit:{0}".format(channel)
+
+
+class TokenBucket:
+    """ an in process token bucket with the same semantics as `TOKEN_BUCKET_SCRIPT`
+    """
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.timestamp = time.time()
+
+    def take(self, cost=1, now=None):
+        now = time.time() if now is None else now
+        elapsed = max(0, now - self.timestamp)
+        self.tokens = min(self.burst, self.tokens + elapsed * self.rate)
+        self.timestamp = now
+        if self.tokens >= cost:
+            self.tokens -= cost
+            return True, 0
+        return False, (cost - self.tokens) / self.rate
+
+
+def get_limit(channel):
+    """ returns the `(rate, burst, policy, max_delay)` limit of a channel, or None if
+    the channel is not rate limited.
+    """
+    config = REDIS_PUBSUB["rate_limit"]
+    if not config:
+        return None
+    config = dict(config, **config.get("channels", {}).get(channel, {}))
+    if not config.get("rate"):
+        return None
+    return (config["rate"], config.get("burst", config["rate"]),
+            config.get("policy", "drop"), config.get("max_delay", 1))
+
+
+class Coalescer:
+    """ holds the latest throttled message per publication key until the channel has
+    tokens again, so a burst of updates to one model collapses into one publication.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._timers = {}
+
+    def add(self, backend, channel, key, message, wait, history=0):
+        with self._lock:
+            pending = self._pending.setdefault(channel, collections.OrderedDict())
+            pending[key] = message, history
+            if channel not in self._timers:
+                self._schedule(backend, channel, wait)
+
+    def _schedule(self, backend, channel, wait):
+        timer = threading.Timer(wait, self.flush, args=(backend, channel))
+        timer.daemon = True
+        self._timers[channel] = timer
+        timer.start()
+
+    def flush(self, backend, channel):
+        """ publish the pending messages of `channel` while it has tokens. the messages
+        are taken from the pending map under the lock, and the backend is called after
+        releasing it, so adding messages never waits on a round trip to redis. the
+        channel keeps its entry in `_timers` until the flush finishes, so a concurrent
+        `.add` does not start a second flush.
+        """
+        limit = get_limit(channel)
+        try:
+            while True:
+                with self._lock:
+                    pending = self._pending.get(channel)
+                    if not pending:
+                        self._pending.pop(channel, None)
+                        self._timers.pop(channel, None)
+                        return
+                    key, (message, history) = pending.popitem(last=False)
+                allowed, wait = backend.take_token(channel, *limit[:2]) \
+                    if limit else (True, 0)
+                if not allowed:
+                    with self._lock:
+                        pending = self._pending.setdefault(channel,
+                                                           collections.OrderedDict())
+                        # a message added for `key` in the meantime is newer
+                        if key not in pending:
+                            pending[key] = message, history
+                            pending.move_to_end(key, last=False)
+                        self._schedule(backend, channel, wait)
+                    return
+                backend.publish(channel, message, history=history)
+        except Exception:
+            with self._lock:
+                self._timers.pop(channel, None)
+            raise
+
+
+COALESCER = Coalescer()
+
+
+def throttled_publish(backend, channel, message, key=None, history=0):
+    """ publish `message` on `channel` if the channel's rate limit allows it. throttled
+    messages are handled according to the limit's policy:
+
+    - `"drop"` discards the message.
+    - `"delay"` blocks the publisher until a token is available, for at most
+      `max_delay` seconds, then drops the message.
+    - `"coalesce"` keeps the latest message per `key` and publishes it once the channel
+      has tokens again.
+
+    every throttled, dropped, delayed and coalesced message is counted in
+    `redis_pubsub.metrics`. `history` is passed on to the backend's `publish`.
+    """
+    limit = get_limit(channel)
+    if limit is None:
+        return backend.publish(channel, message, history=history)
+
+    allowed, wait = backend.take_token(channel, *limit[:2])
+    if allowed:
+        return backend.publish(channel, message, history=history)
+    return handle_throttled(backend, channel, message, limit, wait, key=key,
+                            history=history)
+
+
+def handle_throttled(backend, channel, message, limit, wait, key=None, history=0):
+    """ apply the policy of `limit` to a message that was refused a token, `wait` is
+    the number of seconds until a token is available. see `throttled_publish`.
+    """
+    rate, burst, policy, max_delay = limit
+    metrics.incr("ratelimit.throttled")
+    if policy == "delay" and wait <= max_delay:
+        time.sleep(wait)
+        allowed, wait = backend.take_token(channel, rate, burst)
+        if allowed:
+            metrics.incr("ratelimit.delayed")
+            return backend.publish(channel, message, history=history)
+    elif policy == "coalesce":
+        metrics.incr("ratelimit.coalesced")
+        COALESCER.add(backend, channel, key, message, wait, history=history)
+        return 0
+
+    metrics.incr("ratelimit.dropped")
+    return 0
@@ -0,0 +1,196 @@
+import asyncio
+import logging
+import time
+
+from django.contrib.contenttypes.models import ContentType
+from django.db import transaction
+from django.utils.module_loading import import_string
+
+import redis
+
+from . import REDIS_PUBSUB
+from .sharding import get_addresses
+
+
+__all__ = (
+    "SQLReceiptStore", "RedisReceiptStore", "get_receipt_store", "run_compactor"
+    )
+
+
+logger = logging.getLogger(__name__)
+
+global RECEIPTS
+RECEIPTS = None
+
+
+def get_receipt_store():
+    """ initialize the receipt store configured by `REDIS_PUBSUB["receipts"]`
+    """
+    global RECEIPTS
+    if RECEIPTS is None:  # pragma: no branch
+        RECEIPTS = import_string(REDIS_PUBSUB["receipts"])()
+    return RECEIPTS
+
+
+class SQLReceiptStore:
+    """ writes a ReceivedPublication row for every delivery.
+    """
+    compacts = False
+    # receipts are written on the delivering thread, in the same connection and
+    # transaction as the rest of the delivery.
+    record_in_executor = False
+
+    def record(self, channel_id, subscriber_id, publication):
+        from .models import ReceivedPublication
+        ReceivedPublication.objects.create(
+            channel_id=channel_id,
+            subscriber_id=subscriber_id,
+            publication=publication
+            )
+
+    def received_by(self, publication_type, publication_id, channel):
+        """ subscriber ids with receipts that are not yet stored as ReceivedPublications
+        """
+        return set()
+
+    def compact(self, batch_size=None):
+        return 0
+
+
+# claims the receipt set KEYS[2] if it is still in the index KEYS[1], so that only one
+# compactor claims it. the set is merged into its claim KEYS[3] rather than deleted,
+# returns the subscriber ids of the claim, or nothing when the set was already taken.
+# ARGV[1] is the ttl of the claim.
+CLAIM_SCRIPT = """
+if redis.call("ZREM", KEYS[1], KEYS[2]) == 0 then
+    return false
+end
+if redis.call("EXISTS", KEYS[2]) == 1 then
+    redis.call("SUNIONSTORE", KEYS[3], KEYS[3], KEYS[2])
+    redis.call("DEL", KEYS[2])
+    redis.call("EXPIRE", KEYS[3], ARGV[1])
+end
+return redis.call("SMEMBERS", KEYS[3])
+"""
+
+# puts the claim KEYS[2] back into the receipt set KEYS[1] after its
+# ReceivedPublications could not be stored, merging it with receipts recorded since it
+# was claimed, and re-adds the set to the index KEYS[3]. ARGV[1] is the expiry time of
+# the index entry and ARGV[2] the ttl of the set.
+REQUEUE_SCRIPT = """
+if redis.call("EXISTS", KEYS[2]) == 1 then
+    redis.call("SUNIONSTORE", KEYS[1], KEYS[1], KEYS[2])
+    redis.call("DEL", KEYS[2])
+    redis.call("EXPIRE", KEYS[1], ARGV[2])
+    redis.call("ZADD", KEYS[3], ARGV[1], KEYS[1])
+end
+"""
+
+
+class RedisReceiptStore:
+    """ records deliveries in redis, keeping the delivery path free of SQL writes. each
+    publication on a channel has a set of the subscriber ids it was delivered to, and
+    the sets expire after `REDIS_PUBSUB["receipts_ttl"]` seconds. `.compact` moves
+    receipts into ReceivedPublication rows in bulk, `run_compactor` calls it
+    periodically. compacted receipts are timestamped when they are compacted, and when
+    `REDIS_PUBSUB["receipts_compact_interval"]` is None receipts simply age out.
+
+    the receipt sets are indexed in a sorted set scored by their expiry time, entries
+    of expired sets are pruned as receipts are recorded and compacted so the index does
+    not outgrow the receipts. claimed sets are only deleted once their rows are
+    committed, and are put back when storing the rows fails.
+    """
+    prefix = "redis_pubsub:receipts"
+    index = "redis_pubsub:receipts:index"
+    compacts = True
+    # keeps redis round trips off the event loop.
+    record_in_executor = True
+
+    def __init__(self, address=None):
+        address = address or REDIS_PUBSUB["receipts_address"] or REDIS_PUBSUB["address"]
+        host, port = get_addresses(address)[0]
+        self.client = redis.Redis(host, port, db=REDIS_PUBSUB["db"],
+                                  password=REDIS_PUBSUB["password"])
+        self.ttl = REDIS_PUBSUB["receipts_ttl"]
+        self._claim = self.client.register_script(CLAIM_SCRIPT)
+        self._requeue = self.client.register_script(REQUEUE_SCRIPT)
+
+    def key(self, publication_type_id, publication_id, channel_id):
+        return "{0}:{1}:{2}:{3}".format(
+            self.prefix, channel_id, publication_type_id, publication_id)
+
+    def record(self, channel_id, subscriber_id, publication):
+        publication_type = ContentType.objects.get_for_model(publication)
+        key = self.key(publication_type.pk, publication.pk, channel_id)
+        now = time.time()
+        pipeline = self.client.pipeline(transaction=False)
+        pipeline.sadd(key, subscriber_id)
+        pipeline.expire(key, self.ttl)
+        pipeline.zadd(self.index, **{key: now + self.ttl})
+        pipeline.zremrangebyscore(self.index, "-inf", now)
+        pipeline.execute()
+
+    def received_by(self, publication_type, publication_id, channel):
+        key = self.key(publication_type.pk, publication_id, channel.pk)
+        return set(int(id_) for id_ in self.client.smembers(key))
+
+    def compact(self, batch_size=None):
+        """ move up to `batch_size` publications worth of receipts into the database,
+        returns the number of ReceivedPublications created.
+        """
+        from .models import ReceivedPublication
+
+        batch_size = batch_size or REDIS_PUBSUB["receipts_compact_batch"]
+        self.client.zremrangebyscore(self.index, "-inf", time.time())
+        candidates = [key.decode("utf-8") if isinstance(key, bytes) else key
+                      for key in self.client.zrange(self.index, 0, batch_size - 1)]
+        pipeline = self.client.pipeline(transaction=False)
+        for key in candidates:
+            self._claim(keys=[self.index, key, key + ":claimed"], args=[self.ttl],
+                        client=pipeline)
+        claimed = [(key, subscriber_ids)
+                   for key, subscriber_ids in zip(candidates, pipeline.execute())
+                   if subscriber_ids is not None]
+        keys = [key for key, _ in claimed]
+        receipts = []
+        for key, subscriber_ids in claimed:
+            channel_id, type_id, publication_id = key[len(self.prefix) + 1:].split(":")
+            receipts.extend(ReceivedPublication(
+                channel_id=int(channel_id),
+                subscriber_id=int(subscriber_id),
+                publication_type_id=int(type_id),
+                publication_id=int(publication_id)
+                ) for subscriber_id in subscriber_ids)
+        try:
+            with transaction.atomic():
+                ReceivedPublication.objects.bulk_create(receipts, batch_size=1000)
+        except Exception:
+            pipeline = self.client.pipeline(transaction=False)
+            for key in keys:
+                self._requeue(keys=[key, key + ":claimed", self.index],
+                              args=[time.time() + self.ttl, self.ttl], client=pipeline)
+            pipeline.execute()
+            raise
+        if keys:
+            self.client.delete(*[key + ":claimed" for key in keys])
+        return len(receipts)
+
+
+@asyncio.coroutine
+def run_compactor(interval=None):
+    """ periodically compact the receipt store in the loop's executor.
+    """
+    from .util import run_in_executor
+
+    interval = interval or REDIS_PUBSUB["receipts_compact_interval"]
+    store = get_receipt_store()
+    while True:
+        try:
+            count = yield from run_in_executor(store.compact)
+            if count:
+                logger.info("compacted {0} delivery receipts".format(count))
+        except asyncio.CancelledError:
+            raise
+        except Exception as err:
+            logger.error("compacting delivery receipts failed: {0}".format(err))
+        yield from asyncio.sleep(interval)
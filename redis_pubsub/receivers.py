@@ -1,20 +1,46 @@
 from django.db.models import signals
 from django.dispatch import receiver
 
-from . import models
+from . import metrics, models
+from .cache import serialized
 
 
-def subscribable_changed(sender, instance, created, **kwargs):
-    """ handle publishing a new, or updated subscribable model.
+def subscribable_changed(sender, instance, created, update_fields=None, **kwargs):
+    """ handle publishing a new, or updated subscribable model. updates that change
+    none of the models tracked fields are not published.
     """
+    delta = None
     if created:
         publish = sender.PUBLISH_ON_CREATE
     else:
         publish = sender.PUBLISH_ON_UPDATE
+        dirty = instance.get_dirty_fields(update_fields)
+        if dirty is not None and not dirty:
+            publish = False
+            metrics.incr("publish.unchanged")
+        if sender.PUBLISH_DELTA:
+            delta = dirty
+
+    invalidate_serialized(sender, instance)
 
     if publish:  # pragma: no branch
-        instance.publish()
+        instance.publish(delta=delta)
+    instance.take_publish_snapshot(update_fields)
+
+
+def invalidate_serialized(sender, instance, **kwargs):
+    """ drop cached serializations of a saved, deleted or otherwise changed model.
+    """
+    opts = instance._meta
+    serialized.invalidate("{0}.{1}".format(opts.app_label, opts.model_name), instance.pk)
+
+
+@receiver(signals.m2m_changed)
+def publishable_m2m_changed(sender, instance, **kwargs):
+    if isinstance(instance, models.PublishableModel):
+        invalidate_serialized(type(instance), instance)
 
 
 for subklass in models.PublishableModel.__subclasses__():
     receiver(signals.post_save, sender=subklass)(subscribable_changed)
+    receiver(signals.post_delete, sender=subklass)(invalidate_serialized)
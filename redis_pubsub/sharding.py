@@ -0,0 +1,68 @@
+import bisect
+import hashlib
+
+from . import REDIS_PUBSUB
+
+
+__all__ = (
+    "HashRing", "get_addresses"
+    )
+
+
+def get_addresses(address):
+    """ normalize an address setting into a list of `(host, port)` tuples. the setting
+    may be a single address or a list of addresses.
+    """
+    if address and isinstance(address[0], (list, tuple)):
+        return [tuple(address_) for address_ in address]
+    return [tuple(address)]
+
+
+def _hash(key):
+    return int(hashlib.md5(key.encode("utf-8")).hexdigest()[:16], 16)
+
+
+class HashRing:
+    """ a consistent hash ring of redis addresses. each address is placed on the ring
+    `replicas` times so that channels spread evenly, and adding or removing an address
+    only moves the channels that hashed to that address.
+
+    .. code:: python
+
+        ring = HashRing([("redis-a", 6379), ("redis-b", 6379)])
+        ring.get_node("username:messages")  # ("redis-b", 6379)
+    """
+    def __init__(self, nodes, replicas=None):
+        self.replicas = replicas or REDIS_PUBSUB["shard_replicas"]
+        self.nodes = list(nodes)
+        self._keys = []
+        self._ring = {}
+        for node in self.nodes:
+            self.add_node(node)
+
+    def add_node(self, node):
+        name = "{0}:{1}".format(*node)
+        for replica in range(self.replicas):
+            key = _hash("{0}-{1}".format(name, replica))
+            self._ring[key] = node
+            bisect.insort(self._keys, key)
+        if node not in self.nodes:
+            self.nodes.append(node)
+
+    def remove_node(self, node):
+        name = "{0}:{1}".format(*node)
+        for replica in range(self.replicas):
+            key = _hash("{0}-{1}".format(name, replica))
+            if self._ring.pop(key, None) is not None:
+                self._keys.remove(key)
+        self.nodes.remove(node)
+
+    def get_node(self, channel):
+        """ returns the address that `channel` is routed to.
+        """
+        if len(self.nodes) == 1:
+            return self.nodes[0]
+        if isinstance(channel, bytes):
+            channel = channel.decode("utf-8")
+        index = bisect.bisect(self._keys, _hash(channel)) % len(self._keys)
+        return self._ring[self._keys[index]]
@@ -1,6 +1,10 @@
+import collections
 import functools as ft
 import asyncio
+import itertools
 import json
+import logging
+import uuid
 
 try:
     from django.db.models.loading import get_model
@@ -8,73 +12,280 @@ except ImportError:
     from django.apps import apps
     get_model = apps.get_model
 
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import close_old_connections
+from django.utils.module_loading import import_string
+
 import redis
-import aioredis
 
-from . import REDIS_PUBSUB
+from . import REDIS_PUBSUB, metrics, outbox
+from .cache import LRUCache
 from .compat import ensure_future
+from .pool import ConnectionPool
+from .ratelimit import get_limit, handle_throttled, throttled_publish
+from .receipts import get_receipt_store
+from .sharding import get_addresses
 
 
 __all__ = (
-    "ASYNCREDIS", "SYNCREDIS", "get_async_redis", "get_redis", "redis_channel_reader",
-    "redis_channel_publish", "ChannelReader", "SubscriptionManager"
+    "POOL", "SYNCREDIS", "BACKEND", "create_backend", "get_backend", "get_pool",
+    "get_async_redis", "get_redis",
+    "run_in_executor", "publication_key", "get_present_subscribers", "coalesce_key",
+    "redis_channel_reader", "redis_channel_publish", "redis_channel_publish_many",
+    "Delta", "ChannelReader", "SubscriptionManager"
     )
 
-global SYNCREDIS, ASYNCREDIS
+
+logger = logging.getLogger(__name__)
+
+# readers in the same dedup group share a dedup window, see `SubscriptionManager`
+_DEDUP_GROUPS = itertools.count()
+
+global SYNCREDIS, BACKEND, POOL
 SYNCREDIS = None
-ASYNCREDIS = None
+BACKEND = None
+POOL = None
+
+
+def create_backend():
+    """ initialize an instance of the backend configured by `REDIS_PUBSUB["backend"]`
+    """
+    backend_class = import_string(REDIS_PUBSUB["backend"])
+    return backend_class()
+
+
+def get_backend():
+    """ initialize the backend used for syncronous publishing, see
+    `redis_pubsub.backends`
+    """
+    global BACKEND
+    if BACKEND is None:  # pragma: no branch
+        BACKEND = create_backend()
+    return BACKEND
 
 
 def get_redis():
-    """ initialize a syncronous redis connection
+    """ initialize a syncronous redis connection to the first of
+    `REDIS_PUBSUB["address"]`. publications go through `get_backend`.
     """
     global SYNCREDIS
     if SYNCREDIS is None:  # pragma: no branch
-        host, port = REDIS_PUBSUB["address"]
+        host, port = get_addresses(REDIS_PUBSUB["address"])[0]
         db = REDIS_PUBSUB["db"]
         password = REDIS_PUBSUB["password"]
         SYNCREDIS = redis.Redis(host, port, db=db, password=password)
     return SYNCREDIS
 
 
+def get_pool():
+    """ initialize the pool of asyncronous subscriber connections
+    """
+    global POOL
+    if POOL is None:  # pragma: no branch
+        POOL = ConnectionPool(create_backend)
+    return POOL
+
+
 @asyncio.coroutine
 def get_async_redis():
-    """ initialize an asyncronous redis connection
+    """ lease a subscriber connection from the pool. closing the lease returns its
+    connections to the pool rather than closing them.
     """
-    global ASYNCREDIS
-    if ASYNCREDIS is None or ASYNCREDIS.closed:  # pragma: no branch
-        address = REDIS_PUBSUB["address"]
-        db = REDIS_PUBSUB["db"]
-        password = REDIS_PUBSUB["password"]
-        ASYNCREDIS = yield from aioredis.create_redis(address, db=db, password=password)
-    return ASYNCREDIS
+    return get_pool().lease()
+
+
+def _call_with_connections(func, *args, **kwargs):
+    close_old_connections()
+    try:
+        return func(*args, **kwargs)
+    finally:
+        close_old_connections()
 
 
 @asyncio.coroutine
-def redis_channel_reader(channel, callback):
+def run_in_executor(func, *args, **kwargs):
+    """ run blocking code, such as ORM queries, in the event loop's default executor.
+    executor threads outlive requests, so stale or broken database connections are
+    closed before and after each call, as django does around a request.
+    """
+    loop = asyncio.get_event_loop()
+    call = ft.partial(_call_with_connections, func, *args, **kwargs)
+    return (yield from loop.run_in_executor(None, call))
+
+
+def _load_message(message):
+    if isinstance(message, bytes):
+        message = message.decode("utf-8")
+    return json.loads(message) if isinstance(message, str) else message
+
+
+def _version_key(message):
+    """ identifies a version of a published model, or None for messages without one.
+    """
+    if not isinstance(message, dict) or message.get("version") is None:
+        return None
+    return (message.get("app_label"), message.get("object_name"), message.get("pk"),
+            message["version"])
+
+
+def publication_key(channel_name, message):
+    """ the default ordering key of a message, messages about the same model instance
+    on the same channel are processed in the order they were published.
+    """
+    if not isinstance(message, dict):
+        return channel_name
+    return (channel_name, message.get("app_label"), message.get("object_name"),
+            message.get("pk"))
+
+
+@asyncio.coroutine
+def redis_channel_reader(channel, callback, concurrency=1, key=publication_key):
     """
     :param channel: the subscription channel to wait for messages on.
     :type channel: aioredis.Channel
     :param callback: a coroutine to await when a message is received
     :type callback: coroutine
+    :param concurrency: the maximum number of callbacks in flight. callbacks for
+        messages with the same key always run in the order the messages arrived.
+    :type concurrency: int
+    :param key: a function of `(channel_name, message)` returning a messages ordering
+        key, defaults to the channel and the published model instance.
+    :type key: callable
     """
-    while (yield from channel.wait_message()):
-        message = yield from channel.get_json()
-        continue_ = yield from callback(channel.name, message)
+    if concurrency <= 1:
+        while (yield from channel.wait_message()):
+            message = yield from channel.get_json()
+            continue_ = yield from callback(channel.name, message)
+            if not continue_:
+                channel.close()
+        return
+
+    semaphore = asyncio.Semaphore(concurrency)
+    tails = {}
+    pending = set()
+    state = {"stopped": False}
+
+    @asyncio.coroutine
+    def run(previous, message):
+        if previous is not None:
+            yield from asyncio.wait([previous])
+        if state["stopped"]:
+            return
+        try:
+            continue_ = yield from callback(channel.name, message)
+        except asyncio.CancelledError:
+            raise
+        except Exception as err:
+            state["stopped"] = True
+            state.setdefault("error", err)
+            channel.close()
+            return
         if not continue_:
+            state["stopped"] = True
             channel.close()
 
+    def done(key_, task):
+        semaphore.release()
+        pending.discard(task)
+        if tails.get(key_) is task:
+            del tails[key_]
+
+    try:
+        while not state["stopped"] and (yield from channel.wait_message()):
+            message = yield from channel.get_json()
+            yield from semaphore.acquire()
+            key_ = key(channel.name, message)
+            task = ensure_future(run(tails.get(key_), message))
+            tails[key_] = task
+            pending.add(task)
+            task.add_done_callback(ft.partial(done, key_))
+        if pending:
+            yield from asyncio.gather(*pending)
+    except asyncio.CancelledError:
+        for task in pending:
+            task.cancel()
+        raise
+    if "error" in state:
+        raise state["error"]
+
+
+def get_present_subscribers(channel):
+    """ the ids of the subscribers connected to `channel`, see `SubscriptionManager`.
+    """
+    members = get_backend().get_presence(channel)
+    return set(int(member.split(":")[0]) for member in members)
+
+
+def coalesce_key(channel_name, message):
+    """ the key a throttled message is coalesced by, see `redis_pubsub.ratelimit`.
+    """
+    key = publication_key(channel_name, message)
+    if message.get("delta"):
+        # a coalesced delta may only replace a delta of the same fields
+        key += tuple(sorted(message["delta"]))
+    return key
+
 
-def redis_channel_publish(channel, message):
+def redis_channel_publish(channel, message, history=0):
     """
     :param channel: the channel description of the channel to publish a message on
     :type channel: str
     :param message: a json serializable message to send to the subscribed client
     :type message: dict
+    :param history: the number of messages kept in the channel's history, 0 keeps none
+    :type history: int
+
+    with `REDIS_PUBSUB["outbox"]` the message is written to the outbox in the current
+    transaction instead, and published by the `relay_outbox` command.
+    """
+    redis = get_backend()
+    key = coalesce_key(channel, message)
+    message = json.dumps(message, cls=DjangoJSONEncoder)
+    if REDIS_PUBSUB["outbox"]:
+        return outbox.enqueue(channel, message, history=history)
+    return throttled_publish(redis, channel, message, key=key, history=history)
+
+
+def redis_channel_publish_many(channels, message, history=None):
+    """ publish the same message on many channels in one backend call per shard. the
+    channels histories are appended to and their rate limits are checked in the same
+    call, throttled channels are then handled according to their rate limit policy.
+    returns the total number of receivers, or 0 when the message is written to the
+    outbox.
+
+    :param channels: the names of the channels to publish on
+    :type channels: list
+    :param message: a json serializable message to send to the subscribed clients
+    :type message: dict
+    :param history: the history length of each channel that keeps a history
+    :type history: dict
     """
-    redis = get_redis()
-    message = json.dumps(message)
-    return redis.publish(channel, message)
+    redis = get_backend()
+    channels = list(collections.OrderedDict.fromkeys(channels))
+    body = json.dumps(message, cls=DjangoJSONEncoder)
+    history = history or {}
+    if REDIS_PUBSUB["outbox"]:
+        return outbox.enqueue_many(channels, body, history=history)
+    limits = {channel: get_limit(channel) for channel in channels}
+    limits = {channel: limit for channel, limit in limits.items() if limit is not None}
+    buckets = {channel: limit[:2] for channel, limit in limits.items()}
+    results = redis.publish_many(channels, body, history=history, limits=buckets)
+
+    total = 0
+    for channel, (receivers, wait) in results.items():
+        if receivers is None:
+            receivers = handle_throttled(
+                redis, channel, body, limits[channel], wait,
+                key=coalesce_key(channel, message), history=history.get(channel, 0))
+        total += receivers
+    return total
+
+
+Delta = collections.namedtuple("Delta", ("model", "pk", "fields"))
+Delta.__doc__ = """ the fields changed by an update of a published model, see
+`ChannelReader.on_delta`. `model` is the model class and `fields` maps attnames to
+their new values.
+"""
 
 
 class ChannelReader:
@@ -92,19 +303,81 @@ class ChannelReader:
 
         future = yield from correspondence_reader.listen()
 
-    :param subscriber: and instance of settings.AUTH_USER_MODEL
-    :param channel: an instance of redis_pubsub.Channel
+    a reader keeps the ids of its subscriber and channel and the channel's name rather
+    than model instances, so that an idle connection costs as little memory as
+    possible. `.subscriber` and `.channel` fetch the instances the first time they are
+    read and keep them. the first read queries the database, so on the event loop read
+    them through `run_in_executor`, or use the ids.
+
+    :param subscriber_id: the id of an instance of settings.AUTH_USER_MODEL
+    :param channel_id: the id of an instance of redis_pubsub.Channel
+    :param channel_name: the name of the channel
+    :param dedup_group: readers with the same group are delivered a version of a model
+        once, see `SubscriptionManager`. every reader has its own group by default.
     :param manager: an instance of redis_pubsub.util.SubscriptionManager
-    :param future: an instance of asyncio.Task
+    :param future: an instance of asyncio.Future, resolved when the reader stops
     :param _callback: a coroutine to call when a publication is received through the
         subscription channel.
+    :param _filters: a tuple of predicates on the publication's filter attributes, see
+        `.filter`
+    :param _held: the live publications held back while the reader is backfilled, see
+        `.listen`
     """
+    __slots__ = (
+        "subscriber_id", "channel_id", "channel_name", "dedup_group", "manager",
+        "future", "_callback", "_delta_callback", "_filters", "deliver", "_subscriber",
+        "_channel", "_held"
+        )
+
     def __init__(self, subscription, manager=None):
-        self.subscriber = subscription.subscriber
-        self.channel = subscription.channel
+        self.subscriber_id = subscription.subscriber_id
+        self.channel_id = subscription.channel_id
+        self.channel_name = subscription.channel.name
+        self.dedup_group = next(_DEDUP_GROUPS)
         self._callback = None
+        self._delta_callback = None
+        self._filters = ()
         self.manager = manager
         self.future = None
+        self.deliver = None
+        self._subscriber = None
+        self._channel = None
+        self._held = None
+
+    @classmethod
+    def from_ids(cls, subscriber_id, channel_id, channel_name, manager=None):
+        """ a reader for a subscription that was loaded as values rather than as an
+        instance, see `SubscriptionManager.listen_to_all_subscriptions`.
+        """
+        reader = cls.__new__(cls)
+        reader.subscriber_id = subscriber_id
+        reader.channel_id = channel_id
+        reader.channel_name = channel_name
+        reader.dedup_group = next(_DEDUP_GROUPS)
+        reader._callback = None
+        reader._delta_callback = None
+        reader._filters = ()
+        reader.manager = manager
+        reader.future = None
+        reader.deliver = None
+        reader._subscriber = None
+        reader._channel = None
+        reader._held = None
+        return reader
+
+    @property
+    def subscriber(self):
+        if self._subscriber is None:
+            from django.contrib.auth import get_user_model
+            self._subscriber = get_user_model().objects.get(pk=self.subscriber_id)
+        return self._subscriber
+
+    @property
+    def channel(self):
+        if self._channel is None:
+            from .models import Channel
+            self._channel = Channel.objects.get(pk=self.channel_id)
+        return self._channel
 
     def __call__(self, callback):
         """ A callback takes a single argument of the model it will act upon, this model
@@ -121,28 +394,78 @@ class ChannelReader:
                 # .. does stuff with the message
                 return True
         """
-        from .models import ReceivedPublication
         callback = asyncio.coroutine(callback)
+        receipts = get_receipt_store()
 
         @ft.wraps(callback)
         @asyncio.coroutine
         def wrapper(channel_name, kwargs):
+            if not self.accepts(kwargs):
+                metrics.incr("reader.filtered")
+                return True
+            if kwargs.get("delta") and self._delta_callback is not None:
+                delta = self.get_delta(**kwargs)
+                continue_ = yield from self._delta_callback(channel_name, delta)
+                yield from record(delta.model(pk=delta.pk))
+                return continue_
             publication = self.get_model_instance(**kwargs)
-            continue_ = yield from callback(channel_name, publication)
+            return (yield from self.deliver(channel_name, publication))
 
-            ReceivedPublication.objects.create(
-                channel=self.channel,
-                subscriber=self.subscriber,
-                publication=publication
-                )
+        @asyncio.coroutine
+        def deliver(channel_name, publication):
+            continue_ = yield from callback(channel_name, publication)
+            yield from record(publication)
             return continue_
 
+        @asyncio.coroutine
+        def record(publication):
+            if receipts.record_in_executor:
+                yield from run_in_executor(receipts.record, self.channel_id,
+                                           self.subscriber_id, publication)
+            else:
+                receipts.record(self.channel_id, self.subscriber_id, publication)
+
         self._callback = wrapper
+        self.deliver = deliver
 
         return self
 
     callback = __call__
 
+    def filter(self, predicate):
+        """ only deliver publications whose filter attributes (see
+        `PublishableModel.PUBLISH_FILTER_FIELDS`) satisfy `predicate`. predicates run
+        before the published model is fetched, so a filtered publication costs no
+        queries. publications of models without filter fields have empty attributes.
+
+        .. code:: python
+
+            reader.filter(lambda attrs: attrs.get("author_id") != user.pk)
+        """
+        self._filters += (predicate,)
+        return self
+
+    def on_delta(self, callback):
+        """ handle the updates of models that publish deltas (see
+        `PublishableModel.PUBLISH_DELTA`) with `callback` rather than the reader's
+        callback. `callback` is passed a `Delta` instead of the model, which is not
+        fetched. other publications are still handled by the reader's callback.
+
+        .. code:: python
+
+            @reader.on_delta
+            def status_changed(channel_name, delta):
+                if "status" in delta.fields:
+                    ws.send_str(json.dumps([delta.pk, delta.fields["status"]]))
+                return True
+        """
+        self._delta_callback = asyncio.coroutine(callback)
+        return self
+
+    def accepts(self, message):
+        attrs = message.get("attrs") or {}
+        return all(predicate(attrs) for predicate in self._filters)
+
     @property
     def is_active(self):
         if self.future is not None:
@@ -150,24 +473,149 @@ class ChannelReader:
         return False
 
     @staticmethod
-    def get_model_instance(app_label, object_name, pk):
+    def get_model_instance(app_label, object_name, pk, **kwargs):
+        """ fetch a published model, with the fetch hints of publishable models applied,
+        see `PublishableModel.get_publish_queryset`.
+        """
         klass = get_model(app_label, object_name)
-        return klass.objects.get(pk=pk)
+        get_queryset = getattr(klass, "get_publish_queryset", None)
+        queryset = get_queryset() if get_queryset is not None else klass.objects.all()
+        return queryset.get(pk=pk)
 
     @asyncio.coroutine
-    def listen(self):
+    def history(self, count):
+        """ returns up to the last `count` publications kept in the channel's history
+        (see `Channel.history_length`), oldest first. the history is read and the
+        models are fetched in the loop's executor. filters apply, and a model published
+        more than once is returned once, in the position of its last publication. to
+        deliver the history to the callback and then tail the channel without missing
+        publications in between, use `.listen(backfill=count)`.
+        """
+        return (yield from run_in_executor(self.load_history, count))
+
+    def load_history(self, count):
+        messages = get_backend().history(self.channel_name, count)
+        return self.fetch_publications(messages)
+
+    def fetch_publications(self, messages):
+        """ fetch the models of serialized publications with one query per model,
+        oldest first. filters apply, and a model published more than once is returned
+        once, in the position of its last publication.
+        """
+        messages = [_load_message(message) for message in messages]
+        latest = collections.OrderedDict()
+        for message in messages:
+            if self.accepts(message):
+                key = message["app_label"], message["object_name"], message["pk"]
+                latest.pop(key, None)
+                latest[key] = message
+
+        pks = collections.defaultdict(list)
+        for app_label, object_name, pk in latest:
+            pks[app_label, object_name].append(pk)
+        instances = {}
+        for (app_label, object_name), pks_ in pks.items():
+            klass = get_model(app_label, object_name)
+            get_queryset = getattr(klass, "get_publish_queryset", None)
+            queryset = get_queryset() if get_queryset is not None else klass.objects.all()
+            for pk, instance in queryset.in_bulk(pks_).items():
+                instances[app_label, object_name, pk] = instance
+        return [instances[key] for key in latest if key in instances]
+
+    @asyncio.coroutine
+    def drain_queue(self):
+        """ deliver the publications queued while the subscriber was not connected (see
+        `QueuedPublication`) to the reader's callback, oldest first. the queue is read
+        and emptied in the loop's executor. called by `.listen` when
+        `REDIS_PUBSUB["offline_queue"]` is set.
+        """
+        from .models import QueuedPublication
+
+        if self._callback is None:
+            return
+        messages = yield from run_in_executor(
+            QueuedPublication.objects.drain, self.subscriber_id, self.channel_id)
+        if not messages:
+            return
+        publications = yield from run_in_executor(self.fetch_publications, messages)
+        yield from self._deliver_all(publications)
+
+    @asyncio.coroutine
+    def backfill(self, count):
+        """ deliver up to the last `count` publications kept in the channel's history to
+        the reader's callback, oldest first. returns the versions of the published
+        models that were read, see `.listen(backfill=count)`.
+        """
+        if self._callback is None:
+            return set()
+        messages = yield from run_in_executor(
+            get_backend().history, self.channel_name, count)
+        messages = [_load_message(message) for message in messages]
+        if messages:
+            publications = yield from run_in_executor(self.fetch_publications, messages)
+            yield from self._deliver_all(publications)
+        return set(_version_key(message) for message in messages) - {None}
+
+    @asyncio.coroutine
+    def _deliver_all(self, publications):
+        for publication in publications:
+            if not self.is_active:
+                break
+            try:
+                continue_ = yield from self.deliver(self.channel_name, publication)
+            except Exception as err:
+                self.future.set_exception(err)
+                break
+            if not continue_:
+                self.future.set_result(None)
+                break
+
+    @asyncio.coroutine
+    def _release_held(self, delivered):
+        """ dispatch the live publications held back during a backfill, and any that
+        arrive meanwhile, except the versions in `delivered`.
+        """
+        while self._held and self.is_active:
+            channel_name, message = self._held.popleft()
+            if _version_key(message) not in delivered:
+                yield from self.manager.deliver(self, channel_name, message)
+
+    @staticmethod
+    def get_delta(app_label, object_name, pk, delta, **kwargs):
+        klass = get_model(app_label, object_name)
+        fields = {name: klass._meta.get_field(name).to_python(value)
+                  for name, value in delta.items()}
+        return Delta(klass, pk, fields)
+
+    @asyncio.coroutine
+    def listen(self, backfill=0):
         """ a coroutine object that listens to the pubsub channel and calls. this returns
         a cancellable Future that, with a manager, can be cancelled before it is awaited.
 
+        with `backfill`, the last `backfill` publications kept in the channel's history
+        (see `Channel.history_length`) are delivered first. the channel is subscribed
+        before the history is read and live publications are held back until it has
+        been delivered, so no publication falls between the two, and a version of a
+        model that is both in the history and live is delivered once, from the history.
+
         ::
 
-            yield from reader.listen()
+            yield from reader.listen(backfill=50)
             reader.is_active  # True
         """
         yield from self.get_manager()
-        channel = (yield from self.manager.redis.subscribe(self.channel.name))[0]
-        self.future = ensure_future(redis_channel_reader(channel, self._callback))
-        return self.future
+        if backfill:
+            self._held = collections.deque()
+        try:
+            future = yield from self.manager.listen(self)
+            if REDIS_PUBSUB["offline_queue"]:
+                yield from self.drain_queue()
+            if backfill:
+                delivered = yield from self.backfill(backfill)
+                yield from self._release_held(delivered)
+        finally:
+            self._held = None
+        return future
 
     @asyncio.coroutine
     def get_manager(self):
@@ -178,48 +626,378 @@ class ChannelReader:
         return self.manager
 
 
+class _Lane:
+    """ the `(channel_name, message)` publications of one channel that are queued or
+    being dispatched by a `SubscriptionManager`.
+    """
+    __slots__ = ("queue", "tasks", "tails")
+
+    def __init__(self):
+        self.queue = collections.deque()
+        self.tasks = set()
+        self.tails = {}
+
+
 class SubscriptionManager:
-    """ A proxy class in front of the aioredis object.
+    """ A proxy class in front of a pubsub backend, see `redis_pubsub.backends`.
+
+    any number of readers may listen to the same channel. the channel is subscribed
+    once, every publication is dispatched to each of its readers in turn, and the
+    channel is unsubscribed when its last reader is removed or finishes.
+
+    the publications of every channel are put on a single inbox, read by one task per
+    manager rather than one task per channel, to keep idle connections small. each
+    channel's publications are dispatched one at a time by default, and channels do
+    not wait on each other. with `concurrency` greater than one, up to `concurrency`
+    publications per channel are dispatched at once while publications with the same
+    `key` (by default the same model instance) still run in order, see
+    `redis_channel_reader`.
+
+    with `REDIS_PUBSUB["offline_queue"]` the manager marks the subscribers of its
+    readers as present on their channels, refreshing the presence every third of
+    `REDIS_PUBSUB["presence_ttl"]`, so that publications are only queued for
+    subscribers that are not connected.
+
+    with a `dedup_window` (in seconds, defaults to `REDIS_PUBSUB["dedup_window"]`) a
+    version of a model that was already delivered, or is being delivered, to a
+    reader's dedup group is dropped before it is fetched. every reader is its own
+    group, except that the readers of a `listen_to_all_subscriptions` call share one,
+    so a model published on several of the subscriber's channels reaches their
+    callback once. the last
+    `REDIS_PUBSUB["dedup_size"]` publications are remembered.
+
+    :param readers: a dict of channel names to lists of readers
+    :param inbox: a queue of `(channel_name, message)` pairs for the dispatch task
     """
-    def __init__(self, redis_):
+    __slots__ = (
+        "readers", "redis", "concurrency", "key", "seen", "presence_id", "inbox",
+        "_subscribed", "_lanes", "_dispatcher", "_presence", "_unsubscribing", "_future"
+        )
+
+    def __init__(self, redis_, concurrency=None, key=None, dedup_window=None):
         self.readers = {}
         self.redis = redis_
+        self.concurrency = concurrency or REDIS_PUBSUB["callback_concurrency"]
+        self.key = key or publication_key
+        dedup_window = dedup_window or REDIS_PUBSUB["dedup_window"]
+        self.seen = LRUCache(REDIS_PUBSUB["dedup_size"], ttl=dedup_window) \
+            if dedup_window else None
+        self.presence_id = uuid.uuid4().hex
+        self.inbox = asyncio.Queue()
+        self._subscribed = {}
+        self._lanes = {}
+        self._dispatcher = None
+        self._presence = None
+        self._unsubscribing = set()
         self._future = None
 
     def add(self, *readers):
         for reader in readers:
-            self.readers[reader.channel.name] = reader
+            readers_ = self.readers.setdefault(reader.channel_name, [])
+            if reader not in readers_:
+                readers_.append(reader)
 
     @property
     def closed(self):
         return self.redis.closed
 
+    @asyncio.coroutine
+    def listen(self, reader):
+        """ start dispatching publications to `reader`. returns the readers future, which
+        is resolved when the readers callback returns False and may be cancelled to stop
+        the reader.
+        """
+        future = yield from self._start(reader)
+        if REDIS_PUBSUB["offline_queue"]:
+            yield from self._announce([reader])
+        return future
+
+    @asyncio.coroutine
+    def _start(self, reader):
+        name = reader.channel_name
+        self.add(reader)
+        reader.future = asyncio.Future()
+        reader.future.add_done_callback(ft.partial(self._reader_done, reader))
+        if name not in self._subscribed:
+            self._subscribed[name] = None
+            try:
+                channel = (yield from self.redis.subscribe(name))[0]
+            except Exception:
+                self._subscribed.pop(name, None)
+                raise
+            forward = getattr(channel, "forward", None)
+            if forward is not None:
+                forward(self.inbox.put_nowait)
+            else:
+                self._subscribed[name] = ensure_future(self._forward(channel))
+        if self._dispatcher is None or self._dispatcher.done():
+            self._dispatcher = ensure_future(self._run_dispatcher())
+        return reader.future
+
+    @asyncio.coroutine
+    def _announce(self, readers):
+        """ mark the subscribers of `readers` as present on their channels with a single
+        backend call, and keep refreshing the presence while the manager runs.
+        """
+        presences = collections.defaultdict(list)
+        for reader in readers:
+            presences[reader.channel_name].append(self.presence_member(reader))
+        yield from run_in_executor(self.redis.set_presence_many, dict(presences),
+                                   REDIS_PUBSUB["presence_ttl"])
+        if self._presence is None:
+            self._presence = ensure_future(self._refresh_presence())
+
+    def presence_member(self, reader):
+        """ the presence of `reader`s subscriber through this manager, see
+        `get_present_subscribers`.
+        """
+        return "{0}:{1}".format(reader.subscriber_id, self.presence_id)
+
+    @asyncio.coroutine
+    def _refresh_presence(self):
+        ttl = REDIS_PUBSUB["presence_ttl"]
+        while True:
+            yield from asyncio.sleep(ttl / 3)
+            presences = {}
+            for name, readers in list(self.readers.items()):
+                members = set(self.presence_member(reader) for reader in readers
+                              if reader.is_active)
+                if members:
+                    presences[name] = list(members)
+            if not presences:
+                continue
+            try:
+                yield from run_in_executor(self.redis.set_presence_many, presences, ttl)
+            except asyncio.CancelledError:
+                raise
+            except Exception as err:
+                logger.error("refreshing the presence on {0} channels failed: {1}"
+                             .format(len(presences), err))
+
+    def _leave(self, reader):
+        """ clear the presence of `reader`s subscriber unless another of its readers is
+        still listening on the channel.
+        """
+        readers = self.readers.get(reader.channel_name, ())
+        if any(other.subscriber_id == reader.subscriber_id for other in readers):
+            return
+        self._track(ensure_future(run_in_executor(
+            self.redis.clear_presence, reader.channel_name,
+            [self.presence_member(reader)])))
+
+    def _track(self, task):
+        self._unsubscribing.add(task)
+        task.add_done_callback(self._unsubscribing.discard)
+
+    @asyncio.coroutine
+    def _forward(self, channel):
+        """ put the messages of a channel without `.forward`, such as a raw aioredis
+        channel, on the inbox.
+        """
+        while (yield from channel.wait_message()):
+            message = yield from channel.get_json()
+            self.inbox.put_nowait((channel.name, message))
+
+    @asyncio.coroutine
+    def _run_dispatcher(self):
+        """ the manager's dispatch task. it only sorts the inbox into a lane per channel,
+        the publications themselves are dispatched by short lived tasks so that a slow
+        callback on one channel does not hold up the others.
+        """
+        while True:
+            channel_name, message = yield from self.inbox.get()
+            name = channel_name.decode("utf-8") if isinstance(channel_name, bytes) \
+                else channel_name
+            if isinstance(message, bytes):
+                message = message.decode("utf-8")
+            if isinstance(message, str):
+                try:
+                    message = json.loads(message)
+                except ValueError as err:
+                    logger.error("dropped a malformed publication on {0}: {1}"
+                                 .format(channel_name, err))
+                    continue
+            lane = self._lanes.get(name)
+            if lane is None:
+                lane = self._lanes[name] = _Lane()
+            lane.queue.append((channel_name, message))
+            self._run_lane(name, lane)
+            if not self.readers:
+                return
+
+    def _run_lane(self, name, lane):
+        """ start dispatching the queued publications of a channel, up to `concurrency`
+        at once. publications with the same `key` run in the order they arrived, see
+        `redis_channel_reader`.
+        """
+        while len(lane.tasks) < self.concurrency and lane.queue:
+            channel_name, message = lane.queue.popleft()
+            key_ = self.key(channel_name, message)
+            task = ensure_future(self._dispatch_after(
+                lane.tails.get(key_), channel_name, message))
+            lane.tails[key_] = task
+            lane.tasks.add(task)
+            task.add_done_callback(ft.partial(self._lane_done, name, lane, key_))
+
+    def _lane_done(self, name, lane, key_, task):
+        lane.tasks.discard(task)
+        if lane.tails.get(key_) is task:
+            del lane.tails[key_]
+        if lane.queue:
+            self._run_lane(name, lane)
+        elif not lane.tasks and self._lanes.get(name) is lane:
+            del self._lanes[name]
+
+    def _cancel_lane(self, name, current=None):
+        lane = self._lanes.pop(name, None)
+        if lane is None:
+            return
+        lane.queue.clear()
+        for task in list(lane.tasks):
+            if task is not current:
+                task.cancel()
+
+    @asyncio.coroutine
+    def _dispatch_after(self, previous, channel_name, message):
+        if previous is not None:
+            yield from asyncio.wait([previous])
+        yield from self._dispatch_safely(channel_name, message)
+
+    @asyncio.coroutine
+    def _dispatch_safely(self, channel_name, message):
+        try:
+            yield from self._dispatch(channel_name, message)
+        except asyncio.CancelledError:
+            raise
+        except Exception as err:
+            logger.error("dispatching a publication on {0} failed: {1}"
+                         .format(channel_name, err))
+
+    @asyncio.coroutine
+    def _dispatch(self, channel_name, message):
+        name = channel_name.decode("utf-8") if isinstance(channel_name, bytes) \
+            else channel_name
+        for reader in list(self.readers.get(name, ())):
+            if reader._held is not None:
+                # the reader is being backfilled, see `ChannelReader.listen`
+                reader._held.append((channel_name, message))
+                continue
+            yield from self.deliver(reader, channel_name, message)
+        return bool(self.readers.get(name))
+
+    @asyncio.coroutine
+    def deliver(self, reader, channel_name, message):
+        """ call `reader`s callback with a publication, unless the reader has stopped or
+        the publication is a duplicate.
+        """
+        if reader.future is None or reader.future.done() or reader._callback is None:
+            return
+        if not self.reserve(reader, message):
+            metrics.incr("manager.duplicates")
+            return
+        try:
+            continue_ = yield from reader._callback(channel_name, message)
+        except asyncio.CancelledError:
+            self.release(reader, message)
+            raise
+        except Exception as err:
+            self.release(reader, message)
+            if not reader.future.done():
+                reader.future.set_exception(err)
+        else:
+            if not continue_ and not reader.future.done():
+                reader.future.set_result(None)
+
+    def dedup_key(self, reader, message):
+        version = _version_key(message)
+        if self.seen is None or version is None:
+            return None
+        return (reader.dedup_group,) + version
+
+    def reserve(self, reader, message):
+        """ mark this version of the published model as delivered to `reader`s dedup
+        group before `reader`s callback is awaited, so that the same version dispatched
+        on another channel while the callback runs is dropped. returns False if the
+        version was already delivered, or is being delivered, within the dedup window.
+        """
+        key = self.dedup_key(reader, message)
+        if key is None:
+            return True
+        if key in self.seen:
+            return False
+        self.seen.set(key, True)
+        return True
+
+    def release(self, reader, message):
+        """ forget a reserved version whose callback failed, so it can be delivered
+        again.
+        """
+        key = self.dedup_key(reader, message)
+        if key is not None:
+            self.seen.discard(key)
+
+    def _discard(self, reader):
+        """ forget `reader`, returns True when it was the last reader of its channel.
+        """
+        name = reader.channel_name
+        readers = self.readers.get(name)
+        if readers is None or reader not in readers:
+            return False
+        readers.remove(reader)
+        if REDIS_PUBSUB["offline_queue"]:
+            self._leave(reader)
+        if readers:
+            return False
+        del self.readers[name]
+        current = asyncio.Task.current_task()
+        pump = self._subscribed.pop(name, None)
+        if pump is not None and pump is not current:
+            pump.cancel()
+        self._cancel_lane(name, current)
+        dispatcher = self._dispatcher
+        if not self.readers and dispatcher is not None and dispatcher is not current:
+            dispatcher.cancel()
+        return True
+
+    def _reader_done(self, reader, future):
+        if self._discard(reader) and not self.redis.closed:
+            self._track(ensure_future(self.redis.unsubscribe(reader.channel_name)))
+
     @asyncio.coroutine
     def remove(self, reader):
         if reader.is_active:
             reader.future.cancel()
-        yield from self.redis.unsubscribe(reader.channel.name)
-        self.readers.pop(reader.channel.name, None)
+        if self._discard(reader):
+            yield from self.redis.unsubscribe(reader.channel_name)
 
     @asyncio.coroutine
     def clear(self):
-        coroutines = [self.remove(reader) for reader in self.readers.values()]
+        readers = [reader for readers in self.readers.values() for reader in readers]
+        coroutines = [self.remove(reader) for reader in readers]
         self._future = asyncio.gather(*coroutines, return_exceptions=True)
 
     @asyncio.coroutine
     def wait_closed(self):
         if self._future:
             yield from self._future
+        if self._unsubscribing:
+            yield from asyncio.gather(*self._unsubscribing, return_exceptions=True)
 
     @asyncio.coroutine
     def stop(self):
+        if self._presence is not None:
+            self._presence.cancel()
+        if self._dispatcher is not None:
+            self._dispatcher.cancel()
+        for name in list(self._lanes):
+            self._cancel_lane(name, asyncio.Task.current_task())
         yield from self.clear()
         yield from self.wait_closed()
         self.redis.close()
         yield from self.redis.wait_closed()
 
     @asyncio.coroutine
-    def listen_to_all_subscriptions(self, subscriber, callback):
+    def listen_to_all_subscriptions(self, subscriber, callback, filters=()):
         """ a generic way to listen to all of a clients subscriptions providing a single
         callback. in a websocket setting, you might write something like this::
 
@@ -238,8 +1016,54 @@ class SubscriptionManager:
 
         this method fires all subscriptions with the same callback routine, any and all
         or these subscriptions is cancellable using the `.remove` method.
+
+        the ids of the subscriptions and the names of their channels are loaded with a
+        single query, run in the loop's executor. `filters` are registered with each
+        reader, see `ChannelReader.filter`. only `subscriber.pk` is read, so none of
+        the deferred fields of a user from `redis_pubsub.auth.get_lazy_user` are
+        loaded. the readers share a dedup group, so with a dedup window a model
+        published on several of the subscriber's channels is passed to `callback` once.
+        with `REDIS_PUBSUB["offline_queue"]` the presence on every channel is set with
+        one backend call, and the subscriber's queues are drained in one transaction.
         """
-        for subscription in subscriber.subscriptions.all():
-            reader = subscription.get_reader(manager=self)
+        from .models import Subscription
+
+        queryset = Subscription.objects.filter(subscriber_id=subscriber.pk).values_list(
+            "subscriber_id", "channel_id", "channel__name")
+        subscriptions = yield from run_in_executor(list, queryset)
+        dedup_group = next(_DEDUP_GROUPS)
+        readers = []
+        for subscriber_id, channel_id, channel_name in subscriptions:
+            reader = ChannelReader.from_ids(subscriber_id, channel_id, channel_name,
+                                            manager=self)
+            reader.dedup_group = dedup_group
+            for predicate in filters:
+                reader.filter(predicate)
             reader.callback(callback)
-            yield from reader.listen()
+            yield from self._start(reader)
+            readers.append(reader)
+        if readers and REDIS_PUBSUB["offline_queue"]:
+            yield from self._announce(readers)
+            yield from self._drain_queues(subscriber.pk, readers)
+
+    @asyncio.coroutine
+    def _drain_queues(self, subscriber_id, readers):
+        """ deliver the publications queued for `readers`, which all belong to one
+        subscriber, see `ChannelReader.drain_queue`.
+        """
+        from .models import QueuedPublication
+
+        queued = yield from run_in_executor(
+            QueuedPublication.objects.drain_many, subscriber_id,
+            [reader.channel_id for reader in readers])
+        readers = [reader for reader in readers if reader.channel_id in queued]
+        if not readers:
+            return
+
+        def fetch():
+            return [reader.fetch_publications(queued[reader.channel_id])
+                    for reader in readers]
+
+        publications = yield from run_in_executor(fetch)
+        for reader, publications_ in zip(readers, publications):
+            yield from reader._deliver_all(publications_)
@@ -8,7 +8,7 @@ assert version >= (3, 4), "Requires Python 3.4 or later"
 
 install_requires = [
     "aioredis==0.2.4",
-    "Django>=1.7",
+    "Django>=1.8",
     "redis==2.10.5",
     "hiredis==0.2.0",
     ]
@@ -9,6 +9,8 @@ class Message(PublishableModel):
     """
     PUBLISH_ON_CREATE = True
     PUBLISH_ON_UPDATE = True
+    PUBLISH_FILTER_FIELDS = ("from_user_id",)
+    PUBLISH_SELECT_RELATED = ("from_user",)
 
     from_user = models.ForeignKey(settings.AUTH_USER_MODEL)
     to_user = models.ForeignKey(settings.AUTH_USER_MODEL)
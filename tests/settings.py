@@ -24,3 +24,7 @@ DATABASES = {
 SITE_ID = 1
 
 REDIS_HOST = "localhost", 6379
+
+REDIS_PUBSUB = {
+    "backend": "redis_pubsub.backends.MemoryBackend",
+    }
@@ -1,9 +1,15 @@
 import pytest
+from model_mommy import mommy
+
+from django.contrib.auth import get_user_model
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
 
 from rest_framework.authtoken.models import Token
 from rest_framework_jwt.utils import jwt_payload_handler, jwt_encode_handler
 
 from redis_pubsub import auth
+from redis_pubsub.models import Channel, Subscription
 
 
 @pytest.mark.django_db
@@ -33,3 +39,51 @@ def test_authjwt_method(subscription, expect):
 
     value = auth.authjwt_method(token)
     assert bool(value) is expect
+
+
+@pytest.mark.django_db
+def test_authjwt_method_is_lazy(subscription):
+    user = subscription.subscriber
+    token = jwt_encode_handler(jwt_payload_handler(user=user))
+
+    with CaptureQueriesContext(connection) as queries:
+        value = auth.authjwt_method(token)
+    assert len(queries) == 1, "only the user's existence is checked"
+
+    with CaptureQueriesContext(connection) as queries:
+        assert isinstance(value, get_user_model())
+        assert value.pk == value.id == user.pk
+        assert value.token_claims["username"] == user.username
+        assert value == user
+        assert user == value
+    assert len(queries) == 0
+
+    with CaptureQueriesContext(connection) as queries:
+        assert value.username == user.username
+        assert value.get_username() == user.username
+        assert value.email == user.email
+        assert value.date_joined == user.date_joined
+    assert len(queries) == 1, "the deferred fields are loaded together"
+
+
+@pytest.mark.django_db
+def test_authjwt_method_rejects_deleted_users(subscription):
+    user = subscription.subscriber
+    token = jwt_encode_handler(jwt_payload_handler(user=user))
+    lazy = auth.get_lazy_user(user.pk)
+    user.delete()
+
+    assert auth.authjwt_method(token) is None
+    with pytest.raises(get_user_model().DoesNotExist):
+        lazy.get_username()
+
+
+@pytest.mark.django_db
+def test_lazy_user_works_with_the_orm(subscription):
+    user = auth.get_lazy_user(subscription.subscriber_id)
+    channel = mommy.make(Channel)
+
+    created = channel.subscribe(user)
+    assert created.subscriber_id == user.pk
+    assert list(Subscription.objects.filter(subscriber=user, channel=channel)) == \
+        [created]
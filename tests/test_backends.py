@@ -0,0 +1,100 @@
+import asyncio
+import json
+
+import pytest
+import redis
+
+from redis_pubsub.backends import MemoryBackend, RedisBackend, history_key
+from redis_pubsub.ratelimit import bucket_key
+
+
+LOOP = asyncio.get_event_loop()
+
+
+def test_memory_backend_publish_subscribe():
+    backend = MemoryBackend()
+    publisher = MemoryBackend()
+
+    @asyncio.coroutine
+    def go():
+        channel = (yield from backend.subscribe("test:memory"))[0]
+        assert channel.name == b"test:memory"
+        assert publisher.publish("test:memory", json.dumps({"pk": 1})) == 1
+        assert (yield from channel.wait_message())
+        message = yield from channel.get_json()
+        assert message == {"pk": 1}
+
+        yield from backend.unsubscribe("test:memory")
+        assert not (yield from channel.wait_message())
+        assert publisher.publish("test:memory", json.dumps({"pk": 2})) == 0
+
+        backend.close()
+        yield from backend.wait_closed()
+        assert backend.closed
+
+    LOOP.run_until_complete(go())
+
+
+def test_memory_backend_close_ends_channels():
+    backend = MemoryBackend()
+
+    @asyncio.coroutine
+    def go():
+        channels = yield from backend.subscribe("test:a", "test:b")
+        backend.close()
+        for channel in channels:
+            assert not (yield from channel.wait_message())
+        assert MemoryBackend().publish("test:a", "{}") == 0
+
+    LOOP.run_until_complete(go())
+
+
+def test_memory_backend_history():
+    backend = MemoryBackend()
+    for pk in range(5):
+        backend.publish("test:history", json.dumps({"pk": pk}), history=3)
+    backend.publish("test:history", json.dumps({"pk": 5}))
+
+    assert [json.loads(m)["pk"] for m in backend.history("test:history", 10)] == [2, 3, 4]
+    assert [json.loads(m)["pk"] for m in backend.history("test:history", 2)] == [3, 4]
+    assert backend.history("test:nohistory", 2) == []
+
+
+@pytest.fixture
+def redis_backend(request):
+    backend = RedisBackend()
+    client = backend.get_client(backend.addresses[0])
+    try:
+        client.ping()
+    except redis.ConnectionError:
+        pytest.skip("redis is not available")
+
+    def fin():
+        for name in ("test:many:limited", "test:many:history"):
+            client = backend.get_client(backend.shard_for(name))
+            client.delete(bucket_key(name), history_key(name))
+    request.addfinalizer(fin)
+    return backend
+
+
+def test_redis_backend_publish_many(redis_backend):
+    limited, kept = "test:many:limited", "test:many:history"
+    subscriber = redis_backend.get_client(redis_backend.shard_for(kept)).pubsub()
+    subscriber.subscribe(kept)
+    subscriber.get_message(timeout=1)  # the subscribe confirmation
+
+    history, limits = {kept: 2}, {limited: (1, 1)}
+    for body in ("first", "second", "third"):
+        results = redis_backend.publish_many([limited, kept], body, history=history,
+                                             limits=limits)
+        assert results[kept] == (1, 0)
+        if body == "first":
+            assert results[limited] == (0, 0)
+        else:
+            receivers, wait = results[limited]
+            assert receivers is None
+            assert 0 < wait <= 1
+
+    assert redis_backend.history(kept, 10) == [b"second", b"third"]
+    assert redis_backend.history(limited, 10) == []
+    subscriber.close()
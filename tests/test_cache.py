@@ -0,0 +1,72 @@
+import json
+
+import pytest
+from model_mommy import mommy
+
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+
+from redis_pubsub.cache import LRUCache, SerializationCache, serialized
+
+from testapp.models import Message
+
+
+def test_lru_cache_evicts_least_recently_used():
+    cache = LRUCache(2)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    assert cache.get("a") == 1
+    cache.set("c", 3)
+
+    assert "b" not in cache
+    assert cache.get("a") == 1
+    assert cache.get("c") == 3
+    assert cache.stats() == {"size": 2, "maxsize": 2, "hits": 3, "misses": 0}
+
+
+def test_serialization_cache_invalidate():
+    cache = SerializationCache(10, name=None)
+    cache.set(("app.model", 1, "v1"), "one")
+    cache.set(("app.model", 1, "v2"), "two")
+    cache.set(("app.model", 2, "v1"), "other")
+
+    cache.invalidate("app.model", 1)
+    assert len(cache) == 1
+    assert cache.get(("app.model", 2, "v1")) == "other"
+
+
+@pytest.mark.django_db
+def test_serialize_is_cached(subscription):
+    message = mommy.make(Message, channel=subscription.channel)
+    serialized.clear()
+
+    first = Message.objects.get(pk=message.pk).serialize()
+    second = Message.objects.get(pk=message.pk).serialize()
+    assert first == second
+    assert serialized.stats()["hits"] == 1
+
+    message.body = "changed"
+    message.save()
+    assert "changed" in Message.objects.get(pk=message.pk).serialize()
+
+
+@pytest.mark.django_db
+def test_serialize_with_deferred_fields_serializes_the_loaded_fields(subscription):
+    message = mommy.make(Message, channel=subscription.channel, body="first")
+    serialized.clear()
+
+    deferred = Message.objects.only("id", "channel", "body")
+    instance = deferred.get(pk=message.pk)
+    with CaptureQueriesContext(connection) as queries:
+        fields = json.loads(instance.serialize())[0]["fields"]
+    assert len(queries) == 0
+    assert fields == {"channel": subscription.channel_id, "body": "first"}
+    assert deferred.get(pk=message.pk).serialize() == instance.serialize()
+    assert serialized.stats()["hits"] == 2
+
+    # the full instance is cached separately
+    full = json.loads(Message.objects.get(pk=message.pk).serialize())[0]["fields"]
+    assert full["to_user"] == message.to_user_id
+
+    Message.objects.filter(pk=message.pk).update(body="second")
+    assert "second" in deferred.get(pk=message.pk).serialize()
@@ -1,10 +1,21 @@
 import asyncio
+import json
+import threading
 
 from unittest import mock
 
 import pytest
+from model_mommy import mommy
 
-from redis_pubsub import models, util
+from django.conf import settings
+from django.db import connection
+from django.db.models.query import QuerySet
+from django.test.utils import CaptureQueriesContext
+
+from redis_pubsub import REDIS_PUBSUB, auth, models, util
+from redis_pubsub.backends import LocalChannel, MemoryBackend
+
+from testapp.models import Message
 
 
 LOOP = asyncio.get_event_loop()
@@ -77,6 +88,53 @@ def test_channel_subscription_returns_subscription(subscription):
     assert isinstance(reader, models.Subscription)
 
 
+@pytest.mark.django_db
+def test_channel_subscribe_many(subscription):
+    channel = subscription.channel
+    subscription.active = False
+    subscription.save()
+    subscribers = mommy.make(settings.AUTH_USER_MODEL, _quantity=3)
+
+    with CaptureQueriesContext(connection) as queries:
+        channel.subscribe_many([subscription.subscriber] + subscribers)
+    assert len(queries) <= 7  # savepoints, select, insert and update
+
+    assert channel.subscribers.filter(active=True).count() == 4
+
+    count = channel.unsubscribe_many([s.pk for s in subscribers])
+    assert count == 3
+    assert list(channel.subscribers.filter(active=True)) == [subscription]
+
+
+@pytest.mark.django_db
+def test_channel_publish_many(subscriber):
+    channels = mommy.make(models.Channel, _quantity=3)
+    channels[0].subscribe(subscriber)
+    channels[1].history_length = 5
+    channels[1].save()
+    message = mommy.make(Message, channel=channels[0])
+    backend = MemoryBackend()
+
+    @asyncio.coroutine
+    def go():
+        subscribed = yield from backend.subscribe(*[channel.name for channel in channels])
+        with CaptureQueriesContext(connection) as queries:
+            receivers = models.Channel.objects.publish_many(message, channels)
+        assert len(queries) == 1
+        assert receivers == 2, "the inactive channel without a history is skipped"
+
+        published = yield from subscribed[0].get_json()
+        assert published["pk"] == message.pk
+        history = util.get_backend().history(channels[1].name, 5)
+        assert [json.loads(m)["pk"] for m in history] == [message.pk]
+        yield from asyncio.sleep(0)
+        assert subscribed[2]._queue.empty()
+
+        backend.close()
+
+    LOOP.run_until_complete(go())
+
+
 @pytest.mark.django_db
 def test_close_reader(subscription):
     reader = subscription.get_reader()
@@ -140,3 +198,535 @@ def test_close_manager(subscription):
         assert reader.manager.closed
 
     LOOP.run_until_complete(go())
+
+
+@pytest.mark.django_db(transaction=True)
+def test_listen_to_all_subscriptions_loads_off_loop(subscriber):
+    channels = mommy.make(models.Channel, _quantity=3)
+    for channel in channels:
+        channel.subscribe(subscriber)
+
+    def callback(channel_name, model):
+        return True
+
+    threads = []
+    fetch_all = QuerySet._fetch_all
+
+    def record_thread(queryset):
+        threads.append(threading.current_thread())
+        return fetch_all(queryset)
+
+    @asyncio.coroutine
+    def go():
+        manager = util.SubscriptionManager((yield from util.get_async_redis()))
+        with mock.patch.object(QuerySet, "_fetch_all", record_thread):
+            yield from manager.listen_to_all_subscriptions(subscriber, callback)
+
+        # the subscriptions are loaded in the executor, nothing is queried on the loop
+        assert threads
+        assert threading.current_thread() not in threads
+        assert set(manager.readers) == set(channel.name for channel in channels)
+
+        yield from manager.stop()
+        assert manager.closed
+
+    LOOP.run_until_complete(go())
+
+
+def test_executor_calls_close_old_connections():
+    calls = []
+
+    def query():
+        calls.append("query")
+        return 1
+
+    @asyncio.coroutine
+    def go():
+        with mock.patch.object(util, "close_old_connections",
+                               lambda: calls.append("close")):
+            assert (yield from util.run_in_executor(query)) == 1
+        assert calls == ["close", "query", "close"]
+
+    LOOP.run_until_complete(go())
+
+
+@pytest.mark.django_db
+def test_multiple_readers_per_channel(subscription):
+    name = subscription.channel.name
+    publisher = subscription.subscriber
+    first_m, second_m = mock.Mock(), mock.Mock()
+
+    @asyncio.coroutine
+    def go():
+        manager = util.SubscriptionManager((yield from util.get_async_redis()))
+        first = subscription.get_reader(manager)
+        second = subscription.get_reader(manager)
+        first.callback(lambda channel_name, model: first_m(model) or True)
+        second.callback(lambda channel_name, model: second_m(model) or True)
+
+        yield from first.listen()
+        yield from second.listen()
+        assert manager.readers[name] == [first, second]
+
+        subscription.channel.publish(publisher)
+        yield from asyncio.sleep(0.1)
+        first_m.assert_called_once_with(publisher)
+        second_m.assert_called_once_with(publisher)
+
+        yield from manager.remove(first)
+        assert not first.is_active
+        assert second.is_active
+        assert name in manager.redis._channels, "still subscribed"
+
+        yield from manager.remove(second)
+        assert name not in manager.readers
+        assert name not in manager.redis._channels
+
+        yield from manager.stop()
+
+    LOOP.run_until_complete(go())
+
+
+@pytest.mark.django_db
+def test_reader_filters_before_fetching(subscription):
+    subscriber = subscription.subscriber
+    other = mommy.make(settings.AUTH_USER_MODEL)
+    reader = subscription.get_reader()
+    reader.filter(lambda attrs: attrs.get("from_user_id") != subscriber.pk)
+    m = mock.Mock()
+
+    @reader.callback
+    def callback(channel_name, model):
+        m(model)
+        return False
+
+    get_model_instance = mock.Mock(wraps=util.ChannelReader.get_model_instance)
+
+    @asyncio.coroutine
+    def go():
+        listener = yield from reader.listen()
+        with mock.patch.object(util.ChannelReader, "get_model_instance",
+                               get_model_instance):
+            mommy.make(Message, channel=subscription.channel, from_user=subscriber)
+            message = mommy.make(Message, channel=subscription.channel, from_user=other)
+            yield from listener
+
+        m.assert_called_once_with(message)
+        get_model_instance.assert_called_once_with(
+            app_label="testapp", object_name="Message", pk=message.pk,
+            attrs={"from_user_id": other.pk})
+
+        yield from reader.manager.stop()
+
+    LOOP.run_until_complete(go())
+
+
+@pytest.mark.django_db
+def test_get_model_instance_applies_fetch_hints():
+    message = mommy.make(Message)
+
+    with CaptureQueriesContext(connection) as queries:
+        instance = util.ChannelReader.get_model_instance(
+            app_label="testapp", object_name="Message", pk=message.pk)
+        assert instance.from_user.username == message.from_user.username
+    assert len(queries) == 1
+
+    only = ("id", "body", "channel", "from_user")
+    with mock.patch.object(Message, "PUBLISH_ONLY", only):
+        instance = util.ChannelReader.get_model_instance(
+            app_label="testapp", object_name="Message", pk=message.pk)
+    assert instance.get_deferred_fields() == {"to_user_id"}
+    with CaptureQueriesContext(connection) as queries:
+        instance.get_publish_version()
+    assert len(queries) == 0
+
+
+@pytest.mark.django_db(transaction=True)
+def test_reader_history(subscription):
+    channel = subscription.channel
+    channel.history_length = 3
+    channel.save()
+    subscriber = subscription.subscriber
+    messages = mommy.make(Message, channel=channel, _quantity=4)
+    own = mommy.make(Message, channel=channel, from_user=subscriber)
+    messages[2].body = "edited"
+    messages[2].save()  # published again, so it moves to the end of the history
+    reader = subscription.get_reader()
+
+    @asyncio.coroutine
+    def go():
+        history = yield from reader.history(10)
+        assert history == [messages[3], own, messages[2]]
+
+        reader.filter(lambda attrs: attrs.get("from_user_id") != subscriber.pk)
+        history = yield from reader.history(10)
+        assert history == [messages[3], messages[2]]
+
+    LOOP.run_until_complete(go())
+
+
+@pytest.mark.django_db(transaction=True)
+def test_listen_with_backfill(subscription):
+    channel = subscription.channel
+    channel.history_length = 5
+    channel.save()
+    messages = mommy.make(Message, channel=channel, _quantity=2)
+    received = []
+    reader = subscription.get_reader()
+    reader.callback(lambda channel_name, model: received.append(model.pk) or True)
+    history = MemoryBackend.history
+
+    def publish_then_read(backend, name, count):
+        # published after the reader subscribed and before the history is read
+        messages.append(mommy.make(Message, channel=channel))
+        return history(backend, name, count)
+
+    @asyncio.coroutine
+    def go():
+        with mock.patch.object(MemoryBackend, "history", publish_then_read):
+            yield from reader.listen(backfill=10)
+        messages.append(mommy.make(Message, channel=channel))
+        yield from asyncio.sleep(0.1)
+        assert received == [message.pk for message in messages]
+        yield from reader.manager.stop()
+
+    LOOP.run_until_complete(go())
+
+
+@pytest.mark.django_db(transaction=True)
+def test_offline_queue(subscription):
+    channel = subscription.channel
+    other = mommy.make(models.Subscription, channel=channel)
+    m, other_m = mock.Mock(), mock.Mock()
+    reader = subscription.get_reader()
+    reader.callback(lambda channel_name, model: m(model) or True)
+
+    @asyncio.coroutine
+    def go():
+        yield from reader.listen()
+        assert util.get_present_subscribers(channel.name) == {subscription.subscriber_id}
+
+        message = mommy.make(Message, channel=channel)
+        queued = models.QueuedPublication.objects.values_list("subscriber_id", flat=True)
+        assert list(queued) == [other.subscriber_id], "only the offline subscriber"
+        yield from asyncio.sleep(0.1)
+        m.assert_called_once_with(message)
+
+        other_reader = other.get_reader(manager=reader.manager)
+        other_reader.callback(lambda channel_name, model: other_m(model) or True)
+        yield from other_reader.listen()
+        other_m.assert_called_once_with(message)
+        assert not models.QueuedPublication.objects.exists()
+
+        yield from reader.manager.stop()
+        assert util.get_present_subscribers(channel.name) == set()
+
+    with mock.patch.dict(REDIS_PUBSUB, {"offline_queue": True}):
+        LOOP.run_until_complete(go())
+
+
+@pytest.mark.django_db(transaction=True)
+def test_presence_refresh_survives_errors(subscription):
+    name = subscription.channel.name
+    backend = MemoryBackend()
+    set_presence_many = backend.set_presence_many
+    calls = []
+
+    def flaky_set_presence_many(presences, ttl):
+        calls.append(presences)
+        if len(calls) == 2:
+            raise RuntimeError("redis is down")
+        return set_presence_many(presences, ttl)
+
+    backend.set_presence_many = flaky_set_presence_many
+    reader = subscription.get_reader(util.SubscriptionManager(backend))
+    reader.callback(lambda channel_name, model: True)
+
+    @asyncio.coroutine
+    def go():
+        yield from reader.listen()
+        yield from asyncio.sleep(0.5)
+        assert len(calls) > 2, "the refresh kept running after the error"
+        assert util.get_present_subscribers(name) == {subscription.subscriber_id}
+        yield from reader.manager.stop()
+
+    config = {"offline_queue": True, "presence_ttl": 0.3}
+    with mock.patch.dict(REDIS_PUBSUB, config):
+        LOOP.run_until_complete(go())
+
+
+@pytest.mark.django_db(transaction=True)
+def test_listen_to_all_subscriptions_drains_queues_at_once(subscriber):
+    channels = mommy.make(models.Channel, _quantity=3)
+    for channel in channels:
+        channel.subscribe(subscriber)
+    received = []
+
+    def callback(channel_name, model):
+        received.append(model)
+        return True
+
+    backend = MemoryBackend()
+    backend.set_presence_many = mock.Mock(wraps=backend.set_presence_many)
+    drain_many = mock.Mock(wraps=models.QueuedPublication.objects.drain_many)
+
+    @asyncio.coroutine
+    def go():
+        with mock.patch.dict(REDIS_PUBSUB, {"offline_queue": True}):
+            messages = [mommy.make(Message, channel=channel) for channel in channels]
+            assert models.QueuedPublication.objects.count() == 3
+
+            manager = util.SubscriptionManager(backend)
+            with mock.patch.object(models.QueuedPublication.objects, "drain_many",
+                                   drain_many):
+                yield from manager.listen_to_all_subscriptions(subscriber, callback)
+
+            assert backend.set_presence_many.call_count == 1
+            presences = backend.set_presence_many.call_args[0][0]
+            assert set(presences) == set(channel.name for channel in channels)
+            assert drain_many.call_count == 1
+            assert sorted(received, key=lambda m: m.pk) == messages
+            assert not models.QueuedPublication.objects.exists()
+            yield from manager.stop()
+
+    LOOP.run_until_complete(go())
+
+
+@pytest.mark.django_db(transaction=True)
+def test_manager_drops_duplicates_across_channels(subscriber):
+    channels = mommy.make(models.Channel, _quantity=2)
+    for channel in channels:
+        channel.subscribe(subscriber)
+    message = mommy.make(Message, channel=channels[0])
+    m = mock.Mock()
+
+    @asyncio.coroutine
+    def go():
+        redis_ = yield from util.get_async_redis()
+        manager = util.SubscriptionManager(redis_, dedup_window=10)
+        yield from manager.listen_to_all_subscriptions(
+            subscriber, lambda channel_name, model: m(model) or True)
+
+        models.Channel.objects.publish_many(message, channels)
+        yield from asyncio.sleep(0.1)
+        m.assert_called_once_with(message)
+
+        message.body = "edited"
+        message.save()  # a new version
+        yield from asyncio.sleep(0.1)
+        assert m.call_count == 2
+
+        yield from manager.stop()
+
+    LOOP.run_until_complete(go())
+
+
+@pytest.mark.django_db(transaction=True)
+def test_manager_drops_duplicates_while_the_callback_runs(subscriber):
+    channels = mommy.make(models.Channel, _quantity=2)
+    for channel in channels:
+        channel.subscribe(subscriber)
+    message = mommy.make(Message, channel=channels[0])
+    m = mock.Mock()
+
+    @asyncio.coroutine
+    def callback(channel_name, model):
+        m(model)
+        yield from asyncio.sleep(0.05)  # the other channel is dispatched meanwhile
+        return True
+
+    @asyncio.coroutine
+    def go():
+        redis_ = yield from util.get_async_redis()
+        manager = util.SubscriptionManager(redis_, dedup_window=10)
+        yield from manager.listen_to_all_subscriptions(subscriber, callback)
+
+        models.Channel.objects.publish_many(message, channels)
+        yield from asyncio.sleep(0.2)
+        m.assert_called_once_with(message)
+
+        yield from manager.stop()
+
+    LOOP.run_until_complete(go())
+
+
+def test_manager_releases_failed_deliveries():
+    manager = util.SubscriptionManager(MemoryBackend(), dedup_window=10)
+    first = util.ChannelReader.from_ids(1, 1, "test:first", manager=manager)
+    second = util.ChannelReader.from_ids(1, 2, "test:second", manager=manager)
+    second.dedup_group = first.dedup_group
+    message = {"app_label": "testapp", "object_name": "Message", "pk": 1,
+               "version": "v1"}
+    calls = []
+
+    @asyncio.coroutine
+    def failing(channel_name, message):
+        calls.append(channel_name)
+        raise RuntimeError("the callback failed")
+
+    @asyncio.coroutine
+    def working(channel_name, message):
+        calls.append(channel_name)
+        return True
+
+    @asyncio.coroutine
+    def go():
+        first._callback, second._callback = failing, working
+        first.future, second.future = asyncio.Future(), asyncio.Future()
+        yield from manager.deliver(first, "test:first", message)
+        assert isinstance(first.future.exception(), RuntimeError)
+
+        yield from manager.deliver(second, "test:second", message)
+        yield from manager.deliver(second, "test:second", message)
+        assert calls == ["test:first", "test:second"]
+
+    LOOP.run_until_complete(go())
+
+
+@pytest.mark.django_db(transaction=True)
+def test_manager_dedup_is_per_reader(subscriber):
+    channels = mommy.make(models.Channel, _quantity=2)
+    subscriptions = [channel.subscribe(subscriber) for channel in channels]
+    message = mommy.make(Message, channel=channels[0])
+    m = mock.Mock()
+
+    @asyncio.coroutine
+    def go():
+        redis_ = yield from util.get_async_redis()
+        manager = util.SubscriptionManager(redis_, dedup_window=10)
+        readers = [subscriptions[0].get_reader(manager),
+                   subscriptions[0].get_reader(manager),
+                   subscriptions[1].get_reader(manager)]
+        for i, reader in enumerate(readers):
+            reader.callback(lambda channel_name, model, i=i: m(i) or True)
+            yield from reader.listen()
+
+        models.Channel.objects.publish_many(message, channels)
+        yield from asyncio.sleep(0.1)
+        # every reader of the subscriber is delivered the publication once
+        assert sorted(c[0][0] for c in m.call_args_list) == [0, 1, 2]
+
+        models.Channel.objects.publish_many(message, channels)
+        yield from asyncio.sleep(0.1)
+        assert m.call_count == 3
+
+        yield from manager.stop()
+
+    LOOP.run_until_complete(go())
+
+
+@pytest.mark.parametrize("concurrency", [1, 4])
+def test_reader_concurrency_preserves_order_per_key(concurrency):
+    channel = LocalChannel("test:concurrent")
+    processed = []
+
+    @asyncio.coroutine
+    def callback(channel_name, message):
+        yield from asyncio.sleep(message["delay"])
+        processed.append((message["pk"], message["seq"]))
+        return message["seq"] < 2
+
+    messages = [
+        {"pk": 1, "seq": 0, "delay": 0.05},
+        {"pk": 2, "seq": 0, "delay": 0},
+        {"pk": 1, "seq": 1, "delay": 0},
+        {"pk": 2, "seq": 2, "delay": 0.1},
+        ]
+    for message in messages:
+        channel.put_nowait(json.dumps(message))
+
+    LOOP.run_until_complete(util.redis_channel_reader(channel, callback, concurrency))
+
+    assert processed.index((1, 0)) < processed.index((1, 1))
+    assert processed.index((2, 0)) < processed.index((2, 2))
+    if concurrency > 1:
+        assert processed[0] == (2, 0), "a slow callback does not stall other keys"
+    assert not channel.is_active
+
+
+@pytest.mark.django_db
+def test_manager_dispatches_every_channel_from_one_task(subscriber):
+    channels = mommy.make(models.Channel, _quantity=3)
+    received = []
+
+    @asyncio.coroutine
+    def go():
+        manager = util.SubscriptionManager((yield from util.get_async_redis()))
+        for channel in channels:
+            subscription = channel.subscribe(subscriber)
+            reader = subscription.get_reader(manager)
+            reader.callback(lambda channel_name, model: received.append(model) or True)
+            yield from reader.listen()
+            assert not hasattr(reader, "__dict__")
+            assert reader.channel_name == channel.name
+            assert reader.subscriber_id == subscriber.pk
+
+        dispatcher = manager._dispatcher
+        assert all(pump is None for pump in manager._subscribed.values())
+        for channel in channels:
+            channel.publish(channel)
+        yield from asyncio.sleep(0.1)
+        assert sorted(received, key=lambda c: c.pk) == channels
+        assert manager._dispatcher is dispatcher
+
+        yield from manager.stop()
+        assert dispatcher.cancelled()
+
+    LOOP.run_until_complete(go())
+
+
+@pytest.mark.django_db(transaction=True)
+def test_listen_to_all_subscriptions_with_lazy_user(subscriber):
+    channels = mommy.make(models.Channel, _quantity=2)
+    for channel in channels:
+        channel.subscribe(subscriber)
+    user = auth.get_lazy_user(subscriber.pk)
+
+    @asyncio.coroutine
+    def go():
+        manager = util.SubscriptionManager((yield from util.get_async_redis()))
+        yield from manager.listen_to_all_subscriptions(user, lambda name, model: True)
+        assert set(manager.readers) == set(channel.name for channel in channels)
+        assert "username" in user.get_deferred_fields(), "the user was not loaded"
+        yield from manager.stop()
+
+    LOOP.run_until_complete(go())
+
+
+@pytest.mark.django_db
+def test_slow_channel_does_not_hold_up_other_channels(subscriber):
+    slow, fast = mommy.make(models.Channel, _quantity=2)
+    received = []
+
+    @asyncio.coroutine
+    def wait(channel_name, model):
+        yield from asyncio.sleep(0.5)
+        return True
+
+    @asyncio.coroutine
+    def go():
+        manager = util.SubscriptionManager((yield from util.get_async_redis()))
+        slow_reader = slow.subscribe(subscriber).get_reader(manager)
+        slow_reader.callback(wait)
+        fast_reader = fast.subscribe(subscriber).get_reader(manager)
+        fast_reader.callback(lambda channel_name, model: received.append(model) or True)
+        yield from slow_reader.listen()
+        yield from fast_reader.listen()
+
+        slow.publish(slow)
+        fast.publish(fast)
+        yield from asyncio.sleep(0.1)
+        assert received == [fast]
+
+        yield from manager.stop()
+
+    LOOP.run_until_complete(go())
+
+
+@pytest.mark.django_db
+def test_reader_caches_its_subscriber_and_channel(subscription):
+    reader = subscription.get_reader()
+    with CaptureQueriesContext(connection) as queries:
+        assert reader.subscriber == reader.subscriber == subscription.subscriber
+        assert reader.channel == reader.channel == subscription.channel
+    assert len(queries) == 2
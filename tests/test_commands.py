@@ -0,0 +1,122 @@
+import datetime
+import json
+from unittest import mock
+
+import pytest
+from model_mommy import mommy
+
+from django.core.management import call_command
+from django.utils import timezone
+
+from redis_pubsub import REDIS_PUBSUB, metrics, outbox, util
+from redis_pubsub.backends import MemoryBackend
+from redis_pubsub.models import OutboxPublication, ReceivedPublication, Subscription
+from testapp.models import Message
+
+
+@pytest.mark.django_db
+def test_prune_receipts(subscription):
+    receipts = mommy.make(ReceivedPublication, channel=subscription.channel,
+                          subscriber=subscription.subscriber, _quantity=5)
+    old = timezone.now() - datetime.timedelta(days=40)
+    ReceivedPublication.objects.filter(id__in=[r.id for r in receipts[:3]])\
+                               .update(datetime_received=old)
+
+    call_command("prune_receipts", days=30, batch_size=2)
+
+    remaining = ReceivedPublication.objects.values_list("id", flat=True)
+    assert sorted(remaining) == sorted(r.id for r in receipts[3:])
+
+
+@pytest.mark.django_db
+def test_relay_outbox(subscription):
+    backend = MemoryBackend()
+    backend.publish = mock.Mock(return_value=1)
+    relayed = metrics.get("outbox.relayed")
+
+    with mock.patch.dict(REDIS_PUBSUB, {"outbox": True}), \
+            mock.patch.object(util, "get_backend", return_value=backend):
+        messages = mommy.make(Message, channel=subscription.channel, _quantity=3)
+        assert not backend.publish.called
+        assert OutboxPublication.objects.count() == 3
+
+        call_command("relay_outbox", once=True, batch_size=2)
+
+    assert not OutboxPublication.objects.exists()
+    published = [json.loads(c[0][1])["pk"] for c in backend.publish.call_args_list]
+    assert published == [message.pk for message in messages]
+    assert metrics.get("outbox.relayed") == relayed + 3
+    assert metrics.get("outbox.lag") >= 0
+
+
+@pytest.mark.django_db
+def test_relay_outbox_defers_delayed_rows(subscription):
+    backend = MemoryBackend()
+    backend.publish = mock.Mock(return_value=1)
+    limit = {"rate": 1, "burst": 1, "policy": "delay", "max_delay": 5}
+
+    with mock.patch.dict(REDIS_PUBSUB, {"outbox": True, "rate_limit": limit}), \
+            mock.patch("redis_pubsub.ratelimit.time.sleep") as sleep:
+        first, second = mommy.make(Message, channel=subscription.channel, _quantity=2)
+        assert outbox.relay_batch(backend=backend) == 1
+
+    assert not sleep.called, "the batch's row locks were held while sleeping"
+    assert backend.publish.call_count == 1
+    remaining = OutboxPublication.objects.get()
+    assert json.loads(remaining.message)["pk"] == second.pk
+    assert remaining.not_before > timezone.now()
+    assert outbox.relay_batch(backend=backend) == 0, "the deferred row is not due"
+
+
+@pytest.mark.django_db
+def test_relay_outbox_deferred_rows_do_not_block_other_channels(subscription):
+    backend = MemoryBackend()
+    backend.publish = mock.Mock(return_value=1)
+    limited = subscription.channel.name
+    limit = {"channels": {limited: {"rate": 1, "burst": 1, "policy": "delay",
+                                    "max_delay": 5}}}
+    other = mommy.make(Subscription).channel
+
+    with mock.patch.dict(REDIS_PUBSUB, {"outbox": True, "rate_limit": limit}):
+        mommy.make(Message, channel=subscription.channel, _quantity=2)
+        mommy.make(Message, channel=other, _quantity=2)
+        assert outbox.relay_batch(batch_size=2, backend=backend) == 1
+        assert outbox.relay_batch(batch_size=2, backend=backend) == 2
+
+    channels = [c[0][0] for c in backend.publish.call_args_list]
+    assert channels == [limited, other.name, other.name]
+    assert OutboxPublication.objects.get().channel == limited
+
+
+@pytest.mark.django_db
+def test_relay_outbox_keeps_coalesced_rows(subscription):
+    backend = MemoryBackend()
+    backend.publish = mock.Mock(return_value=1)
+    limit = {"rate": 1, "burst": 1, "policy": "coalesce"}
+    coalesced = metrics.get("outbox.coalesced")
+
+    with mock.patch.dict(REDIS_PUBSUB, {"outbox": True, "rate_limit": limit}):
+        message = mommy.make(Message, channel=subscription.channel, body="first")
+        for body in ("second", "third"):
+            message.body = body
+            message.save()
+        ids = list(OutboxPublication.objects.order_by("id").values_list("id", flat=True))
+        assert outbox.relay_batch(backend=backend) == 2
+        assert backend.publish.call_count == 1
+
+        # only the latest update waits in the outbox, rather than in memory
+        latest = OutboxPublication.objects.get()
+        assert latest.id == ids[-1]
+        assert latest.not_before > timezone.now()
+        assert metrics.get("outbox.coalesced") == coalesced + 1
+
+        call_command("relay_outbox", once=True)
+        assert OutboxPublication.objects.exists(), "the coalesced row is not due yet"
+
+        OutboxPublication.objects.update(not_before=timezone.now())
+        backend.take_token = mock.Mock(return_value=(True, 0))
+        with mock.patch.object(util, "get_backend", return_value=backend):
+            call_command("relay_outbox", once=True)
+
+    assert not OutboxPublication.objects.exists()
+    assert backend.publish.call_count == 2
@@ -0,0 +1,123 @@
+import asyncio
+import json
+
+from redis_pubsub.backends import MemoryBackend
+from redis_pubsub.pool import ConnectionPool
+
+
+LOOP = asyncio.get_event_loop()
+
+
+def test_leases_share_a_subscription():
+    pool = ConnectionPool(MemoryBackend)
+    first, second = pool.lease(), pool.lease()
+
+    @asyncio.coroutine
+    def go():
+        channel_a = (yield from first.subscribe("test:pool"))[0]
+        channel_b = (yield from second.subscribe("test:pool"))[0]
+        assert len(pool.connections) == 1
+        assert pool.router.publish("test:pool", json.dumps({"pk": 1})) == 1
+
+        assert (yield from channel_a.get_json()) == {"pk": 1}
+        assert (yield from channel_b.get_json()) == {"pk": 1}
+
+        first.close()
+        yield from first.wait_closed()
+        assert first.closed
+        assert not pool.connections[0].backend.closed
+        assert not (yield from channel_a.wait_message())
+
+        pool.router.publish("test:pool", json.dumps({"pk": 2}))
+        assert (yield from channel_b.get_json()) == {"pk": 2}
+
+        second.close()
+        yield from second.wait_closed()
+        assert pool.router.publish("test:pool", "{}") == 0
+        pool.close()
+
+    LOOP.run_until_complete(go())
+
+
+def test_pool_caps_channels_per_connection():
+    pool = ConnectionPool(MemoryBackend, max_channels=2)
+    lease = pool.lease()
+
+    @asyncio.coroutine
+    def go():
+        yield from lease.subscribe("test:a", "test:b", "test:c")
+        assert len(pool.connections) == 2
+        lease.close()
+        yield from lease.wait_closed()
+        assert len(pool.connections) == 1
+        pool.close()
+
+    LOOP.run_until_complete(go())
+
+
+def test_pool_resubscribes_dropped_channels():
+    pool = ConnectionPool(MemoryBackend, backoff=(0.01, 0.1))
+    lease = pool.lease()
+
+    @asyncio.coroutine
+    def go():
+        channel = (yield from lease.subscribe("test:drop"))[0]
+        backend = pool.connections[0].backend
+        dropped = (yield from backend.subscribe("test:drop"))[0]
+        dropped.close()  # simulate a dropped connection
+        yield from asyncio.sleep(0.05)
+
+        pool.router.publish("test:drop", json.dumps({"pk": 1}))
+        assert (yield from channel.get_json()) == {"pk": 1}
+        lease.close()
+        yield from lease.wait_closed()
+        pool.close()
+
+    LOOP.run_until_complete(go())
+
+
+class FlakyBackend(MemoryBackend):
+    """ a backend whose subscriptions take a moment, and fail while `fail` is set.
+    """
+    fail = False
+    calls = 0
+
+    @asyncio.coroutine
+    def subscribe(self, *channels):
+        FlakyBackend.calls += 1
+        yield from asyncio.sleep(0.01)
+        if self.fail:
+            raise ConnectionError("subscribe failed")
+        return (yield from super().subscribe(*channels))
+
+
+def test_concurrent_subscribes_wait_for_the_backend():
+    pool = ConnectionPool(FlakyBackend)
+    first, second = pool.lease(), pool.lease()
+    FlakyBackend.calls = 0
+
+    @asyncio.coroutine
+    def go():
+        FlakyBackend.fail = True
+        results = yield from asyncio.gather(first.subscribe("test:flaky"),
+                                            second.subscribe("test:flaky"),
+                                            return_exceptions=True)
+        assert all(isinstance(result, ConnectionError) for result in results)
+        assert FlakyBackend.calls == 1
+        assert pool.router.publish("test:flaky", "{}") == 0
+
+        FlakyBackend.fail = False
+        channel_a, channel_b = yield from asyncio.gather(first.subscribe("test:flaky"),
+                                                         second.subscribe("test:flaky"))
+        assert FlakyBackend.calls == 2
+        pool.router.publish("test:flaky", json.dumps({"pk": 1}))
+        assert (yield from channel_a[0].get_json()) == {"pk": 1}
+        assert (yield from channel_b[0].get_json()) == {"pk": 1}
+
+        first.close()
+        second.close()
+        yield from first.wait_closed()
+        yield from second.wait_closed()
+        pool.close()
+
+    LOOP.run_until_complete(go())
@@ -0,0 +1,86 @@
+import time
+from unittest import mock
+
+import pytest
+
+from redis_pubsub import REDIS_PUBSUB, metrics, util
+from redis_pubsub.backends import MemoryBackend
+from redis_pubsub.ratelimit import (Coalescer, TokenBucket, get_limit,
+                                    throttled_publish)
+
+
+@pytest.fixture
+def backend():
+    backend_ = MemoryBackend()
+    backend_.publish = mock.Mock(return_value=1)
+    return backend_
+
+
+def test_token_bucket():
+    bucket = TokenBucket(rate=10, burst=2)
+    now = bucket.timestamp
+    assert bucket.take(now=now) == (True, 0)
+    assert bucket.take(now=now) == (True, 0)
+    allowed, wait = bucket.take(now=now)
+    assert not allowed
+    assert wait == pytest.approx(0.1)
+    assert bucket.take(now=now + 0.2)[0]
+
+
+def test_get_limit_channel_overrides():
+    config = {"rate": 10, "channels": {"hot": {"rate": 1, "policy": "coalesce"}}}
+    with mock.patch.dict(REDIS_PUBSUB, {"rate_limit": config}):
+        assert get_limit("cold") == (10, 10, "drop", 1)
+        assert get_limit("hot") == (1, 1, "coalesce", 1)
+    assert get_limit("cold") is None
+
+
+def test_throttled_publish_drops(backend):
+    dropped = metrics.get("ratelimit.dropped")
+    with mock.patch.dict(REDIS_PUBSUB, {"rate_limit": {"rate": 1, "burst": 2}}):
+        results = [throttled_publish(backend, "test:drop", "{}") for _ in range(3)]
+
+    assert results == [1, 1, 0]
+    assert backend.publish.call_count == 2
+    assert metrics.get("ratelimit.dropped") == dropped + 1
+
+
+def test_throttled_publish_coalesces(backend):
+    config = {"rate": 20, "burst": 1, "policy": "coalesce"}
+    with mock.patch.dict(REDIS_PUBSUB, {"rate_limit": config}):
+        for body in ("first", "second", "third"):
+            throttled_publish(backend, "test:coalesce", body, key=("message", 1))
+        time.sleep(0.2)
+
+    assert [c[0][1] for c in backend.publish.call_args_list] == ["first", "third"]
+
+
+def test_coalescer_does_not_hold_its_lock_while_publishing(backend):
+    coalescer = Coalescer()
+    locked = []
+
+    def publish(channel, message, history=0):
+        locked.append(not coalescer._lock.acquire(blocking=False))
+        if not locked[-1]:
+            coalescer._lock.release()
+        return 1
+
+    backend.publish = publish
+    coalescer.add(backend, "test:coalesce:lock", ("message", 1), "first", 0)
+    coalescer.add(backend, "test:coalesce:lock", ("message", 2), "second", 0)
+    time.sleep(0.1)
+
+    assert locked == [False, False]
+    assert "test:coalesce:lock" not in coalescer._timers
+
+
+def test_publish_many_checks_rate_limits(backend):
+    dropped = metrics.get("ratelimit.dropped")
+    channels = ["test:many:a", "test:many:b"]
+    with mock.patch.dict(REDIS_PUBSUB, {"rate_limit": {"rate": 1, "burst": 1}}), \
+            mock.patch.object(util, "get_backend", return_value=backend):
+        assert util.redis_channel_publish_many(channels, {"pk": 1}) == 2
+        assert util.redis_channel_publish_many(channels, {"pk": 2}) == 0
+
+    assert backend.publish.call_count == 2
+    assert metrics.get("ratelimit.dropped") == dropped + 2
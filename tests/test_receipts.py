@@ -0,0 +1,104 @@
+import asyncio
+import threading
+
+from unittest import mock
+
+import pytest
+import redis
+from model_mommy import mommy
+
+from django.contrib.contenttypes.models import ContentType
+
+from redis_pubsub import receipts
+from redis_pubsub.models import ReceivedPublication
+
+from testapp.models import Message
+
+
+LOOP = asyncio.get_event_loop()
+
+
+@pytest.fixture
+def store(request):
+    store_ = receipts.RedisReceiptStore()
+    try:
+        store_.client.ping()
+    except redis.ConnectionError:
+        pytest.skip("redis is not available")
+
+    def fin():
+        for key in store_.client.keys(store_.prefix + "*"):
+            store_.client.delete(key)
+    request.addfinalizer(fin)
+    return store_
+
+
+@pytest.mark.django_db
+def test_redis_receipts_are_compacted(subscription, store):
+    message = mommy.make(Message, channel=subscription.channel)
+    ct = ContentType.objects.get_for_model(message)
+
+    store.record(subscription.channel_id, subscription.subscriber_id, message)
+    assert not ReceivedPublication.objects.exists()
+    assert store.received_by(ct, message.pk, subscription.channel) == \
+        {subscription.subscriber.pk}
+
+    with mock.patch.object(receipts, "RECEIPTS", store):
+        assert Message.objects.get_undelivered() == []
+
+    assert store.compact() == 1
+    received = ReceivedPublication.objects.get()
+    assert received.publication == message
+    assert received.subscriber == subscription.subscriber
+    assert store.received_by(ct, message.pk, subscription.channel) == set()
+    assert store.compact() == 0
+
+
+@pytest.mark.django_db
+def test_redis_receipts_index_is_pruned(subscription, store):
+    message = mommy.make(Message, channel=subscription.channel)
+    store.client.zadd(store.index, **{store.prefix + ":0:0:0": 1})
+
+    store.record(subscription.channel_id, subscription.subscriber_id, message)
+    assert store.client.zcard(store.index) == 1
+
+
+@pytest.mark.django_db
+def test_redis_receipts_are_requeued_when_compacting_fails(subscription, store):
+    message = mommy.make(Message, channel=subscription.channel)
+    ct = ContentType.objects.get_for_model(message)
+    store.record(subscription.channel_id, subscription.subscriber_id, message)
+
+    with mock.patch.object(ReceivedPublication.objects, "bulk_create",
+                           side_effect=RuntimeError("database is down")):
+        with pytest.raises(RuntimeError):
+            store.compact()
+
+    assert not ReceivedPublication.objects.exists()
+    assert store.received_by(ct, message.pk, subscription.channel) == \
+        {subscription.subscriber_id}
+    assert store.compact() == 1
+    assert ReceivedPublication.objects.count() == 1
+
+
+class ThreadRecordingStore(receipts.SQLReceiptStore):
+    record_in_executor = True
+
+    def __init__(self):
+        self.threads = []
+
+    def record(self, channel_id, subscriber_id, publication):
+        self.threads.append(threading.current_thread())
+
+
+@pytest.mark.django_db
+def test_receipts_are_recorded_in_the_executor(subscription):
+    message = mommy.make(Message, channel=subscription.channel)
+    store = ThreadRecordingStore()
+    with mock.patch.object(receipts, "RECEIPTS", store):
+        reader = subscription.get_reader()
+        reader.callback(lambda channel_name, model: True)
+
+    assert LOOP.run_until_complete(reader.deliver(subscription.channel.name, message))
+    assert store.threads
+    assert threading.current_thread() not in store.threads
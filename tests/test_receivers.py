@@ -2,7 +2,9 @@ import asyncio
 from unittest import mock
 
 import pytest
+from model_mommy import mommy
 
+from redis_pubsub import util
 from testapp.models import Message
 
 
@@ -56,3 +58,72 @@ def test_post_save_signals(subscription):
         assert reader.manager.closed
 
     LOOP.run_until_complete(go())
+
+
+@pytest.mark.django_db
+def test_dirty_fields(subscription):
+    message = mommy.make(Message, channel=subscription.channel, body="hi!")
+    assert message.get_dirty_fields() == {}
+
+    message = Message.objects.get(pk=message.pk)
+    message.body = "oh sorry"
+    assert message.get_dirty_fields() == {"body": "oh sorry"}
+    message.save()
+    assert message.get_dirty_fields() == {}
+
+    assert Message(body="new").get_dirty_fields() is None
+
+
+@pytest.mark.django_db
+def test_publish_delta(subscription):
+    reader = subscription.get_reader()
+    message = mommy.make(Message, channel=subscription.channel, body="hi!")
+    m = mock.Mock()
+
+    @reader.callback
+    def callback(channel_name, model):
+        raise AssertionError("the model should not be fetched")
+
+    @reader.on_delta
+    def on_delta(channel_name, delta):
+        m(delta)
+        return False
+
+    @asyncio.coroutine
+    def go():
+        listener = yield from reader.listen()
+        with mock.patch.object(Message, "PUBLISH_DELTA", True):
+            message.body = "oh sorry"
+            message.save()
+        yield from listener
+
+        m.assert_called_once_with(util.Delta(Message, message.pk, {"body": "oh sorry"}))
+
+        yield from reader.manager.stop()
+
+    LOOP.run_until_complete(go())
+
+
+@pytest.mark.django_db
+def test_unchanged_saves_are_not_published(subscription):
+    message = mommy.make(Message, channel=subscription.channel, body="hi!")
+    message = Message.objects.get(pk=message.pk)
+
+    with mock.patch("redis_pubsub.util.redis_channel_publish") as publish:
+        message.save()
+        assert not publish.called
+
+        message.body = "oh sorry"
+        message.save(update_fields=["to_user"])
+        assert not publish.called, "body was not saved"
+
+        message.save(update_fields=["body"])
+        assert publish.call_count == 1
+
+        with mock.patch.object(Message, "PUBLISH_TRACKED_FIELDS", ("to_user",)):
+            message.body = "hi again"
+            message.save()
+            assert publish.call_count == 1
+            message.to_user = subscription.subscriber
+            message.save()
+            assert publish.call_count == 2
@@ -0,0 +1,37 @@
+import pytest
+
+from redis_pubsub.sharding import HashRing, get_addresses
+
+
+@pytest.mark.parametrize("address, expect", [
+    (("localhost", 6379), [("localhost", 6379)]),
+    ([("a", 6379), ("b", 6379)], [("a", 6379), ("b", 6379)]),
+    ([["a", 6379]], [("a", 6379)]),
+    ])
+def test_get_addresses(address, expect):
+    assert get_addresses(address) == expect
+
+
+def test_hash_ring_is_stable():
+    nodes = [("a", 6379), ("b", 6379), ("c", 6379)]
+    ring = HashRing(nodes)
+    channels = ["user{0}:messages".format(i) for i in range(1000)]
+    routed = {channel: ring.get_node(channel) for channel in channels}
+
+    assert set(routed.values()) == set(nodes)
+    assert routed == {channel: HashRing(nodes).get_node(channel) for channel in channels}
+    assert ring.get_node(b"user1:messages") == routed["user1:messages"]
+
+
+def test_hash_ring_only_moves_removed_channels():
+    nodes = [("a", 6379), ("b", 6379), ("c", 6379)]
+    ring = HashRing(nodes)
+    channels = ["user{0}:messages".format(i) for i in range(1000)]
+    before = {channel: ring.get_node(channel) for channel in channels}
+
+    ring.remove_node(("c", 6379))
+    for channel in channels:
+        if before[channel] != ("c", 6379):
+            assert ring.get_node(channel) == before[channel]
+        else:
+            assert ring.get_node(channel) != ("c", 6379)
@@ -0,0 +1,38 @@
+import asyncio
+import time
+from unittest import mock
+
+from redis_pubsub import metrics
+from redis_pubsub.compat import ensure_future
+from redis_pubsub.contrib.websockets import watchdog
+
+
+LOOP = asyncio.get_event_loop()
+
+
+def test_watchdog_reports_stalls():
+    stalls = metrics.get("loop.stalls")
+    dog = watchdog.LoopWatchdog(LOOP, threshold=0.05, interval=0.01)
+
+    @asyncio.coroutine
+    def handler(channel_name):
+        time.sleep(0.2)  # blocks the loop
+
+    @asyncio.coroutine
+    def go():
+        dog.start()
+        yield from asyncio.sleep(0.05)
+        task = ensure_future(handler(b"test:stalled"))
+        watchdog.label_task(task, "handler /stalled/")
+        yield from task
+        yield from asyncio.sleep(0.05)
+        dog.stop()
+
+    with mock.patch.object(watchdog.logger, "warning") as warning:
+        LOOP.run_until_complete(go())
+
+    assert metrics.get("loop.stalls") == stalls + 1
+    report = warning.call_args[0][0]
+    assert "handler /stalled/ (channel test:stalled)" in report
+    assert "time.sleep(0.2)" in report
+    assert metrics.get("loop.lag") >= 0
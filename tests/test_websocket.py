@@ -1,16 +1,18 @@
 import json
 import asyncio
+from unittest import mock
 
 import pytest
 from model_mommy import mommy
 
 from aiohttp import ws_connect, WSServerHandshakeError
-from aiohttp.web import Application, MsgType
+from aiohttp.web import Application, MsgType, WebSocketResponse
 
 from rest_framework.authtoken.models import Token
 
+from redis_pubsub import REDIS_PUBSUB, metrics
 from redis_pubsub.contrib.websockets import websocket, websocket_pubsub
-from redis_pubsub.contrib.websockets.util import _clean_route
+from redis_pubsub.contrib.websockets.util import ManagedWebSocketResponse, _clean_route
 
 from testapp.models import Message
 
@@ -290,7 +292,7 @@ def test_websocket_pubsub_wrapper_valid_token(subscription):
     loop.run_until_complete(go(loop))
 
 
-@pytest.mark.django_db
+@pytest.mark.django_db(transaction=True)
 def test_all_subscriptions(subscription):
     loop = asyncio.get_event_loop()
     token, _ = Token.objects.get_or_create(user=subscription.subscriber)
@@ -341,3 +343,92 @@ def test_all_subscriptions(subscription):
         yield from srv.wait_closed()
 
     loop.run_until_complete(go(loop))
+
+
+def test_websocket_reaps_unresponsive_connections():
+    loop = asyncio.get_event_loop()
+    reaped = metrics.get("websockets.reaped")
+    m = mock.Mock()
+
+    @websocket("/")
+    def handler(ws, params, **kwargs):
+        try:
+            yield from asyncio.sleep(10)
+        except asyncio.CancelledError:
+            m()
+            raise
+
+    @asyncio.coroutine
+    def start_server(loop):
+        app = Application()
+        app.router.add_route(*handler.route)
+        srv = yield from loop.create_server(app.make_handler(), "localhost", 9000)
+        return srv
+
+    @asyncio.coroutine
+    def go(loop):
+        srv = yield from start_server(loop)
+        # the client never calls receive, so pings are never answered
+        client = yield from ws_connect("http://localhost:9000")
+        yield from asyncio.sleep(0.5)
+
+        assert m.called
+        assert metrics.get("websockets.reaped") == reaped + 1
+
+        yield from client.close()
+        srv.close()
+        yield from srv.wait_closed()
+
+    heartbeat = {"websocket_ping_interval": 0.1, "websocket_pong_timeout": 0.1}
+    with mock.patch.dict(REDIS_PUBSUB, heartbeat):
+        loop.run_until_complete(go(loop))
+
+
+def test_websocket_pubsub_batching():
+    loop = asyncio.get_event_loop()
+
+    @websocket_pubsub("/", batch=True, batch_size=3)
+    def handler(ws, params, **kwargs):
+        for i in range(4):
+            ws.send_str(str(i))
+        yield from ws.receive()
+
+    @asyncio.coroutine
+    def start_server(loop):
+        app = Application()
+        app.router.add_route(*handler.route)
+        srv = yield from loop.create_server(app.make_handler(), "localhost", 9000)
+        return srv
+
+    @asyncio.coroutine
+    def go(loop):
+        srv = yield from start_server(loop)
+        client = yield from ws_connect("http://localhost:9000")
+        message = yield from client.receive()
+        assert json.loads(message.data) == ["0", "1", "2"]
+        message = yield from client.receive()
+        assert json.loads(message.data) == ["3"]
+
+        yield from client.close()
+        srv.close()
+        yield from srv.wait_closed()
+
+    loop.run_until_complete(go(loop))
+
+
+def test_managed_websocket_receive_wakes_when_the_transport_breaks():
+    loop = asyncio.get_event_loop()
+    broken = ConnectionResetError("connection reset by peer")
+
+    @asyncio.coroutine
+    def go():
+        ws = ManagedWebSocketResponse()
+        with mock.patch.object(WebSocketResponse, "receive", side_effect=broken):
+            ws._start_reading()
+            message = yield from asyncio.wait_for(ws.receive(), 1)
+        assert message.tp == MsgType.error
+        assert message.data is broken
+        # the closing frame is returned again rather than blocking
+        assert (yield from asyncio.wait_for(ws.receive(), 1)) is message
+
+    loop.run_until_complete(go())